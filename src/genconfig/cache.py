@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+#
+# Generator result cache for selective regeneration.
+#
+# Each generator (the generate callback of a NodeDef) is fingerprinted
+# with the input tokens of the nodes it is fed with, the nodes of the
+# node types it declares as dependencies and the source of the module
+# implementing it. The CfgFS entries the generator produced are stored
+# with the fingerprint in a cache file next to the destination directory.
+# On the next run generators with an unchanged fingerprint are skipped
+# and their cached entries are restored into CfgFS verbatim. Generators
+# reading files of the previous run are only skipped if those files are
+# still the same as when the cached entries were produced, or are the
+# cached entries themselves: reading back its own output, a generator has
+# to produce it again unchanged.
+
+import os, json
+from hashlib import sha1
+import genconfig.log as log
+from genconfig.parser import Parser
+
+class Cache:
+    VERSION = 1
+
+    def __init__(self, path, profile, explain = False):
+        self.path = path
+        self.profile = profile
+        self.explain = explain
+        self.sources = {}
+        self.digests = {}
+        self.generators = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != Cache.VERSION or \
+           data.get('profile') != self.profile:
+            return {}
+        return data.get('generators', {})
+
+    def save(self, fs):
+        generators = {}
+        for name, digest in self.digests.items():
+            entries = fs.owned(name)
+            # files spilled to disk are too large to keep in the cache
+            spilled = any(getattr(x, 'spilled', None) is not None
+                          for x in entries)
+            generators[name] = {
+                'digest': digest,
+                'shared': any(len(x.owners) > 1 for x in entries),
+                'spilled': spilled,
+                'inputs': fs.inputs.get(name, {}),
+                'entries': [] if spilled else [x.state() for x in entries]
+            }
+        data = {
+            'version': Cache.VERSION,
+            'profile': self.profile,
+            'generators': generators
+        }
+        os.makedirs(os.path.dirname(self.path), 0o755, True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+        self.generators = generators
+
+    def source(self, generate):
+        path = generate.__code__.co_filename
+        if path not in self.sources:
+            with open(path, 'rb') as f:
+                self.sources[path] = sha1(f.read()).hexdigest()
+        return self.sources[path]
+
+    def digest(self, nodedef, fs):
+        csum = sha1()
+        csum.update(('%d:%s:%s:%s:' % (Cache.VERSION, self.profile,
+                                       nodedef.name, fs.canonical)).encode())
+        csum.update(self.source(nodedef.generate).encode())
+        for node in nodedef.nodes:
+            node.digest(csum, True)
+        for name in nodedef.depends:
+            csum.update(('@%s' % name).encode())
+            if name in Parser.nodes.keys():
+                for node in Parser.nodes[name].nodes:
+                    node.digest(csum, True)
+        return csum.hexdigest()
+
+    def input_digest(self, name, path, fs):
+        fs.previous(path)
+        return fs.inputs[name][path]
+
+    def output_digest(self, path, cached):
+        for state in cached['entries']:
+            if state['path'] == path and 'content' in state:
+                return sha1(state['content'].encode()).hexdigest()
+        return None
+
+    def input_changed(self, name, path, digest, cached, fs):
+        current = self.input_digest(name, path, fs)
+        if current == digest:
+            return False
+        return current is None or current != self.output_digest(path, cached)
+
+    def explain_why(self, name, why):
+        if self.explain:
+            log.progress('%s: %s' % (name, why))
+
+    def reuse(self, nodedef, fs):
+        name = nodedef.name
+        digest = self.digests[name] = self.digest(nodedef, fs)
+        cached = self.generators.get(name)
+
+        if cached is None:
+            why = 'no cached results'
+        elif cached['digest'] != digest:
+            why = 'inputs changed'
+        elif cached['shared']:
+            why = 'outputs shared with other generators'
+        elif cached.get('spilled'):
+            why = 'outputs too large to cache'
+        elif any(x['path'] in fs.files for x in cached['entries']):
+            why = 'outputs overlap with other generators'
+        elif any(self.input_changed(name, path, digest, cached, fs)
+                 for path, digest in cached.get('inputs', {}).items()):
+            why = 'previous outputs changed'
+        else:
+            for state in cached['entries']:
+                fs.restore(state)
+            self.explain_why(name, 'skipped, inputs unchanged ' +
+                             '(reused %d entries)' % len(cached['entries']))
+            return True
+
+        self.explain_why(name, 'regenerated, %s' % why)
+        return False
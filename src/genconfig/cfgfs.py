@@ -1,63 +1,811 @@
 #!/usr/bin/env python3
 
-import sys, os
+import sys, os, stat, json, shutil, tarfile, io, fcntl, threading, bisect
+import errno
+import ctypes, ctypes.util
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
 import genconfig.log as log
 
+def syncfs(path):
+    """Flush the filesystem of path, or all of them if syncfs is missing."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        fn = libc.syncfs
+    except (OSError, AttributeError):
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if fn(fd) != 0:
+            os.sync()
+    finally:
+        os.close(fd)
+
+STATE_DIR = '/var/lib/gen-config'
+
+def state_path(destdir, suffix):
+    """
+    Path of the state gen-config keeps for destdir: a dot file beside the
+    destination directory, for / in STATE_DIR, never inside the tree.
+    """
+    destdir = os.path.abspath(destdir).rstrip('/')
+    if not destdir:
+        return os.path.join(STATE_DIR, 'root' + suffix)
+    return os.path.join(os.path.dirname(destdir),
+                        '.' + os.path.basename(destdir) + suffix)
+
 class CfgFS:
+    class Manifest:
+        """
+        Size, mtime, inode and content hash of files written earlier to
+        a destination directory. A file whose stat data still matches its
+        manifest entry is trusted to have the recorded content, so it can
+        be checked without reading it.
+        """
+
+        NAME = '.gen-config.manifest'
+        VERSION = 1
+
+        def __init__(self, destdir):
+            self.path = state_path(destdir, CfgFS.Manifest.NAME)
+            self.old = {}
+            self.new = {}
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                if data.get('version') == CfgFS.Manifest.VERSION:
+                    self.old = data['files']
+            except (OSError, ValueError, KeyError):
+                pass
+
+        def stat_entry(self, st, csum):
+            return [st.st_size, st.st_mtime_ns, st.st_ino, csum]
+
+        def match(self, path, st, csum):
+            return self.old.get(path) == self.stat_entry(st, csum)
+
+        def record(self, path, st, csum):
+            self.new[path] = self.stat_entry(st, csum)
+
+        def save(self):
+            if self.new == self.old:
+                return
+            os.makedirs(os.path.dirname(self.path), 0o755, exist_ok = True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({ 'version': CfgFS.Manifest.VERSION,
+                            'files': self.new }, f, sort_keys = True)
+            os.replace(tmp, self.path)
+            self.old = self.new
+
+    class Scan:
+        """
+        Destination type, size and link target of CfgFS entries, fetched
+        with a single scan of every directory holding any of them. Also
+        tracks existing directories to avoid creating parents repeatedly.
+        """
+
+        def __init__(self, destdir, paths):
+            self.destdir = destdir
+            self.stats = {}
+            self.targets = {}
+            self.dirs = set()
+            self.created = set()
+            names = {}
+            for path in paths:
+                dir, name = os.path.split(path)
+                names.setdefault(dir, set()).add(name)
+            for dir in sorted(names.keys()):
+                self.scan(dir, names[dir])
+
+        def scan(self, dir, names):
+            try:
+                with os.scandir(self.destdir + dir) as entries:
+                    self.dirs.add(dir)
+                    for e in entries:
+                        if e.name not in names:
+                            continue
+                        path = os.path.join(dir, e.name)
+                        self.stats[path] = e.stat(follow_symlinks = False)
+                        if e.is_symlink():
+                            self.targets[path] = os.readlink(e.path)
+            except OSError:
+                pass
+
+        def lstat(self, path):
+            return self.stats.get(path)
+
+        def readlink(self, path):
+            return self.targets.get(path)
+
+        def mkdirs(self, dir):
+            if dir in self.dirs:
+                return
+            os.makedirs(self.destdir + dir, 0o755, True)
+            while dir not in self.dirs and dir != '/':
+                self.dirs.add(dir)
+                self.created.add(dir)
+                dir = os.path.dirname(dir)
+
+    class Batch:
+        """
+        Changed entries written under temporary names and renamed in
+        place together. Durability costs one filesystem sync for all the
+        data and one fsync per directory touched, not one per file.
+        """
+
+        SUFFIX = '.gen-config-tmp'
+
+        def __init__(self, destdir):
+            self.destdir = destdir
+            self.pending = []
+            self.removed = []
+
+        @staticmethod
+        def tmpname(path):
+            dir, name = os.path.split(path)
+            return os.path.join(dir, '.' + name + CfgFS.Batch.SUFFIX)
+
+        def add(self, tmp, path):
+            self.pending.append((tmp, path))
+
+        def remove(self, path):
+            self.removed.append(path)
+
+        def finish(self, scan):
+            if not self.pending and not self.removed and not scan.created:
+                return
+            syncfs(self.destdir)
+            dirs = set()
+            for tmp, path in sorted(self.pending):
+                os.rename(tmp, path)
+                dirs.add(os.path.dirname(path))
+            for path in sorted(self.removed):
+                CfgFS.unlink(path)
+                dirs.add(os.path.dirname(path))
+            for dir in scan.created:
+                dirs.add(os.path.dirname(self.destdir + dir))
+            for dir in sorted(dirs):
+                fd = os.open(dir, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            self.pending = []
+            self.removed = []
+
+    class Generations:
+        """
+        Numbered generation directories of a destination directory and
+        the current symlink pointing to the active one. Switching between
+        generations is a single atomic symlink replacement.
+        """
+
+        DIR = 'generations'
+        CURRENT = 'current'
+
+        def __init__(self, destdir):
+            self.destdir = destdir
+            self.dir = os.path.join(destdir, CfgFS.Generations.DIR)
+            self.link = os.path.join(destdir, CfgFS.Generations.CURRENT)
+
+        def list(self):
+            try:
+                names = os.listdir(self.dir)
+            except OSError:
+                return []
+            return sorted(int(x) for x in names if x.isdigit())
+
+        def current(self):
+            try:
+                name = os.path.basename(os.readlink(self.link))
+            except OSError:
+                return None
+            return int(name) if name.isdigit() else None
+
+        def path(self, gen):
+            return os.path.join(self.dir, str(gen))
+
+        def switch(self, gen):
+            log.progress('switching to generation %d...' % gen)
+            tmp = self.link + CfgFS.Batch.SUFFIX
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            os.symlink(os.path.join(CfgFS.Generations.DIR, str(gen)), tmp)
+            os.rename(tmp, self.link)
+            fd = os.open(self.destdir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        def prune(self, keep):
+            current = self.current()
+            old = [x for x in self.list() if x != current]
+            for gen in old[0:max(0, len(old) - (keep - 1))]:
+                log.progress('removing generation %d...' % gen)
+                shutil.rmtree(self.path(gen))
+                CfgFS.unlink(state_path(self.path(gen), CfgFS.Manifest.NAME))
+
+    class Store:
+        """
+        Content-addressed object store shared by several destination
+        directories. Files are written once into the store, keyed by
+        their hash and mode, and linked into each destination either as
+        hardlinks or as reflinks. Each destination records the objects it
+        references, unreferenced objects are garbage collected.
+        """
+
+        FICLONE = 0x40049409
+
+        def __init__(self, path, reflink = False):
+            self.path = os.path.abspath(path)
+            self.objects = os.path.join(self.path, 'objects')
+            self.refs = os.path.join(self.path, 'refs')
+            self.reflink = reflink
+            self.lock = threading.Lock()
+            self.written = 0
+            self.reused = 0
+
+        def key(self, f):
+            return '%s-%o' % (f.sha1(), f.mode)
+
+        def object(self, key):
+            return os.path.join(self.objects, key[0:2], key[2:])
+
+        def put(self, f):
+            key = self.key(f)
+            path = self.object(key)
+            with self.lock:
+                if os.path.exists(path):
+                    self.reused += f.size
+                    return path
+            # objects are written in parallel, the lock only orders their
+            # renames; atomic commits flush the filesystem they are linked on
+            os.makedirs(os.path.dirname(path), 0o755, exist_ok = True)
+            tmp = CfgFS.Batch.tmpname('%s.%d.%d' % (path, os.getpid(),
+                                                    threading.get_ident()))
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, f.mode)
+            try:
+                os.fchmod(fd, f.mode)
+                f.dump(fd)
+            finally:
+                os.close(fd)
+            with self.lock:
+                # stored by another writer meanwhile, keep its inode
+                if os.path.exists(path):
+                    os.unlink(tmp)
+                    self.reused += f.size
+                    return path
+                os.rename(tmp, path)
+                self.written += f.size
+            return path
+
+        def linked(self, f, st):
+            # reflinks cannot be told apart from copies, trust the content
+            path = self.put(f)
+            if self.reflink:
+                return True
+            return st is not None and os.stat(path).st_ino == st.st_ino
+
+        def clone(self, src, dst):
+            sfd = os.open(src, os.O_RDONLY)
+            try:
+                dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                              os.fstat(sfd).st_mode & 0o7777)
+                try:
+                    try:
+                        fcntl.ioctl(dfd, CfgFS.Store.FICLONE, sfd)
+                    except OSError:
+                        # no reflink support, fall back to a copy
+                        os.ftruncate(dfd, 0)
+                        os.sendfile(dfd, sfd, 0, os.fstat(sfd).st_size)
+                finally:
+                    os.close(dfd)
+            finally:
+                os.close(sfd)
+
+        def link(self, f, path, batch = None):
+            obj = self.put(f)
+            tmp = CfgFS.Batch.tmpname(path)
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            if self.reflink:
+                self.clone(obj, tmp)
+            else:
+                os.link(obj, tmp)
+            st = os.stat(tmp)
+            if batch is not None:
+                batch.add(tmp, path)
+            else:
+                os.rename(tmp, path)
+            return st
+
+        def refname(self, destdir):
+            return os.path.join(self.refs,
+                                sha1(destdir.encode('utf-8')).hexdigest())
+
+        def save(self, destdir, keys):
+            os.makedirs(self.refs, 0o755, exist_ok = True)
+            path = self.refname(destdir)
+            tmp = CfgFS.Batch.tmpname(path)
+            with open(tmp, 'w') as f:
+                json.dump({ 'destdir': destdir, 'objects': sorted(keys) }, f)
+            os.replace(tmp, path)
+
+        def load(self):
+            refs = {}
+            try:
+                names = os.listdir(self.refs)
+            except OSError:
+                return refs
+            for name in sorted(names):
+                path = os.path.join(self.refs, name)
+                try:
+                    with open(path, 'r') as f:
+                        ref = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                refs[path] = ref
+            return refs
+
+        def scan(self):
+            objects = {}
+            for dir, _, names in os.walk(self.objects):
+                for name in names:
+                    if name.endswith(CfgFS.Batch.SUFFIX):
+                        continue
+                    st = os.lstat(os.path.join(dir, name))
+                    objects[os.path.basename(dir) + name] = st
+            return objects
+
+        def gc(self):
+            referenced = set()
+            for path, ref in self.load().items():
+                if not os.path.isdir(ref['destdir']):
+                    log.progress('dropping references of %s...' %
+                                 ref['destdir'])
+                    os.unlink(path)
+                    continue
+                referenced.update(ref['objects'])
+            removed = 0
+            freed = 0
+            for key, st in self.scan().items():
+                # an object still linked somewhere is in use regardless
+                if key in referenced or st.st_nlink > 1:
+                    continue
+                log.progress('removing unreferenced object %s...' % key)
+                os.unlink(self.object(key))
+                removed += 1
+                freed += st.st_size
+            return removed, freed
+
+        def stats(self):
+            objects = self.scan()
+            unique = sum(st.st_size for st in objects.values())
+            logical = 0
+            references = 0
+            for ref in self.load().values():
+                for key in ref['objects']:
+                    if key in objects:
+                        logical += objects[key].st_size
+                        references += 1
+            return { 'objects': len(objects), 'references': references,
+                     'unique': unique, 'logical': logical,
+                     'ratio': logical / unique if unique else 1.0,
+                     'written': self.written, 'reused': self.reused }
+
+    class ChangeSet:
+        """
+        The outcome of a commit: the status of every generated path,
+        together with the generators owning it. A change set is true
+        if anything was added, modified or removed.
+        """
+
+        ADDED = 'added'
+        MODIFIED = 'modified'
+        UNCHANGED = 'unchanged'
+        REMOVED = 'removed'
+
+        def __init__(self):
+            self.changes = {}
+            self.lock = threading.Lock()
+
+        def record(self, path, status, owners = [], delta = None):
+            with self.lock:
+                self.changes[path] = (status, list(owners), delta)
+
+        def track(self, entry, existed, changed, delta = None):
+            if not changed:
+                status = CfgFS.ChangeSet.UNCHANGED
+            elif existed:
+                status = CfgFS.ChangeSet.MODIFIED
+            else:
+                status = CfgFS.ChangeSet.ADDED
+            self.record(entry.path, status, entry.owners, delta)
+            return changed
+
+        def paths(self, status = None):
+            return sorted(k for k, v in self.changes.items()
+                          if status is None or v[0] == status)
+
+        def changed(self):
+            return sorted(k for k, v in self.changes.items()
+                          if v[0] != CfgFS.ChangeSet.UNCHANGED)
+
+        def owners(self, path):
+            return self.changes[path][1]
+
+        def status(self, path):
+            return self.changes[path][0]
+
+        def delta(self, path):
+            return self.changes[path][2]
+
+        def state(self):
+            state = {}
+            for k, v in sorted(self.changes.items()):
+                state[k] = { 'status': v[0], 'owners': v[1] }
+                if v[2] is not None:
+                    state[k]['delta'] = v[2]
+            return state
+
+        def __bool__(self):
+            return len(self.changed()) > 0
+
+    class Archive:
+        """
+        Streaming tar or cpio (newc) archive writer. Headers carry fixed
+        ownership, inode numbers and timestamps, so the same tree always
+        produces the same archive.
+        """
+
+        FORMATS = ['tar', 'cpio']
+        CPIO_MAGIC = b'070701'
+        CPIO_TRAILER = 'TRAILER!!!'
+
+        def __init__(self, f, format = 'tar', mtime = 0):
+            if format not in CfgFS.Archive.FORMATS:
+                raise RuntimeError('unknown archive format %s' % format)
+            self.f = f
+            self.format = format
+            self.mtime = mtime
+            self.ino = 0
+            self.inodes = {}
+            if format == 'tar':
+                self.tar = tarfile.open(fileobj = f, mode = 'w|',
+                                        format = tarfile.PAX_FORMAT)
+
+        def name(self, path):
+            return path.lstrip('/') or '.'
+
+        def tarinfo(self, path, type, mode, size = 0, target = ''):
+            info = tarfile.TarInfo(self.name(path))
+            info.type = type
+            info.mode = mode
+            info.size = size
+            info.linkname = target
+            info.mtime = self.mtime
+            info.uid = info.gid = 0
+            info.uname = info.gname = 'root'
+            return info
+
+        def cpio(self, path, mode, data = b'', nlink = 1, ino = None):
+            if ino is None:
+                self.ino += 1
+                ino = self.ino
+            name = path.encode('utf-8') + b'\0'
+            fields = [ino, mode, 0, 0, nlink, self.mtime, len(data),
+                      0, 0, 0, 0, len(name), 0]
+            hdr = CfgFS.Archive.CPIO_MAGIC + \
+                b''.join(b'%08X' % x for x in fields) + name
+            self.f.write(hdr + b'\0' * (-len(hdr) % 4))
+            if data:
+                self.f.write(data + b'\0' * (-len(data) % 4))
+            return ino
+
+        def add_dir(self, path, mode):
+            if self.format == 'tar':
+                self.tar.addfile(self.tarinfo(path, tarfile.DIRTYPE, mode))
+            else:
+                self.cpio(self.name(path), stat.S_IFDIR | mode, nlink = 2)
+
+        def add_file(self, path, mode, data, nlink = 1):
+            if self.format == 'tar':
+                self.tar.addfile(self.tarinfo(path, tarfile.REGTYPE, mode,
+                                              len(data)), io.BytesIO(data))
+            else:
+                mode |= stat.S_IFREG
+                ino = self.cpio(self.name(path), mode, data, nlink)
+                self.inodes[path] = (ino, mode, nlink)
+
+        def add_symlink(self, path, target):
+            if self.format == 'tar':
+                self.tar.addfile(self.tarinfo(path, tarfile.SYMTYPE, 0o777,
+                                              target = target))
+            else:
+                self.cpio(self.name(path), stat.S_IFLNK | 0o777,
+                          target.encode('utf-8'))
+
+        def add_hardlink(self, path, target):
+            # the target must have been added before its links
+            if self.format == 'tar':
+                self.tar.addfile(self.tarinfo(path, tarfile.LNKTYPE, 0o644,
+                                              target = self.name(target)))
+            else:
+                ino, mode, nlink = self.inodes[target]
+                self.cpio(self.name(path), mode, nlink = nlink, ino = ino)
+
+        def close(self):
+            if self.format == 'tar':
+                self.tar.close()
+            else:
+                self.cpio(CfgFS.Archive.CPIO_TRAILER, 0, ino = 0)
+            self.f.flush()
+
+    class Spool:
+        """
+        Temporary files beside the destination directory for generated
+        files grown past a size threshold. Spilled files are committed by
+        renaming them in place, the ones never committed are removed by
+        cleanup.
+        """
+
+        NAME = '.gen-config-spool'
+
+        def __init__(self, destdir, threshold):
+            self.dir = state_path(destdir, CfgFS.Spool.NAME)
+            self.threshold = threshold
+            self.count = 0
+            self.files = set()
+            self.lock = threading.Lock()
+
+        def create(self, mode):
+            os.makedirs(self.dir, 0o700, exist_ok = True)
+            with self.lock:
+                self.count += 1
+                path = os.path.join(self.dir, '%d.%d' % (os.getpid(),
+                                                         self.count))
+                self.files.add(path)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+            return path, fd
+
+        def release(self, path):
+            # path was moved out of or removed from the spool
+            with self.lock:
+                self.files.discard(path)
+
+        def cleanup(self):
+            with self.lock:
+                for path in sorted(self.files):
+                    CfgFS.unlink(path)
+                self.files = set()
+            try:
+                os.rmdir(self.dir)
+            except OSError:
+                pass
+
     class File:
-        def __init__(self, path, mode):
+        CHUNK = 65536
+
+        def __init__(self, path, mode, spool = None):
             self.path = path
             self.mode = mode
+            self.owners = []
+            self.chunks = []
+            self.size = 0
+            self.hash = sha1()
             self.csum = None
-            self.buf = ''
-    
+            self.buf = None
+            self.spool = spool
+            self.spilled = None
+            self.fd = None
+
         def write(self, buf, end = '\n'):
-            self.buf += buf + end
-            self.csum = None
+            data = bytes(buf + end, 'ascii')
+            self.hash.update(data)
+            self.size += len(data)
+            self.csum = self.buf = None
+            if self.spilled is not None:
+                if self.fd is None:
+                    self.fd = os.open(self.spilled, os.O_WRONLY | os.O_APPEND)
+                os.write(self.fd, data)
+                return
+            self.chunks.append(data)
+            if self.spool is not None and self.size > self.spool.threshold:
+                self.spill()
+
+        def spill(self):
+            self.spilled, self.fd = self.spool.create(self.mode)
+            for chunk in self.chunks:
+                os.write(self.fd, chunk)
+            self.chunks = []
+
+        def settle(self, path):
+            # the content is now at path, the spilled copy is not needed
+            if self.spilled is not None and self.spilled != path:
+                self.close()
+                os.unlink(self.spilled)
+                self.spool.release(self.spilled)
+                self.spilled = path
+
+        def move(self, path):
+            # the spool may be on another filesystem, copy it then
+            self.close()
+            try:
+                os.rename(self.spilled, path)
+                return
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+            CfgFS.unlink(path)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         self.mode)
+            try:
+                self.dump(fd)
+            finally:
+                os.close(fd)
+            os.unlink(self.spilled)
 
         def close(self):
-            pass
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
 
-        def content(self):
+        def data(self):
+            # spilled files are streamed by dump and hashed incrementally,
+            # never read back into memory as a whole
+            if self.spilled is not None:
+                raise RuntimeError('%s is spilled to disk' % self.path)
+            if self.buf is None:
+                self.buf = b''.join(self.chunks)
+                self.chunks = [self.buf]
             return self.buf
 
+        def dump(self, fd):
+            if self.spilled is None:
+                os.write(fd, self.data())
+                return
+            self.close()
+            with open(self.spilled, 'rb') as f:
+                for block in iter(lambda: f.read(CfgFS.File.CHUNK), b''):
+                    os.write(fd, block)
+
+        def digest(self, f):
+            csum = sha1()
+            for block in iter(lambda: f.read(CfgFS.File.CHUNK), b''):
+                csum.update(block)
+            return csum.hexdigest()
+
+        def content(self):
+            return self.data().decode('ascii')
+
+        def state(self):
+            return { 'type': 'file', 'path': self.path, 'mode': self.mode,
+                     'content': self.content() }
+
+        def node(self):
+            return { 'type': 'file', 'mode': self.mode, 'data': self.data() }
+
         def sha1(self):
             if not self.csum:
-                buf = self.content()
-                self.csum = sha1(bytearray(self.content(), 'ascii')).hexdigest()
+                self.csum = self.hash.hexdigest()
             return self.csum
 
-        def checkfs(self, destdir):
+        def checkfs(self, destdir, scan = None, manifest = None):
+            path = destdir + self.path
+            scan = scan or CfgFS.Scan(destdir, [self.path])
+            st = scan.lstat(self.path)
             try:
-                with open(destdir + self.path) as f:
-                    buf = f.read()
-                    csum = sha1(bytearray(buf, 'ascii')).hexdigest()
-                    return csum == self.sha1()
-            except:
+                if st is None:
+                    return False
+                if stat.S_ISLNK(st.st_mode):
+                    st = os.stat(path)
+                if manifest is not None:
+                    if manifest.match(self.path, st, self.sha1()):
+                        manifest.record(self.path, st, self.sha1())
+                        return True
+                # a size mismatch is a change, no need to read it
+                if self.spilled is not None:
+                    if st.st_size != self.size:
+                        return False
+                    with open(path, 'rb') as f:
+                        if self.digest(f) != self.sha1():
+                            return False
+                        if manifest is not None:
+                            manifest.record(self.path, os.fstat(f.fileno()),
+                                            self.sha1())
+                        return True
+                data = self.data()
+                if st.st_size != len(data):
+                    return False
+                with open(path, 'rb') as f:
+                    if f.read(len(data) + 1) != data:
+                        return False
+                    if manifest is not None:
+                        manifest.record(self.path, os.fstat(f.fileno()),
+                                        self.sha1())
+                    return True
+            except OSError:
                 return False
 
-        def commit(self, destdir):
-            if self.checkfs(destdir):
+        def commit(self, destdir, scan = None, manifest = None, batch = None,
+                   store = None):
+            scan = scan or CfgFS.Scan(destdir, [self.path])
+            if self.checkfs(destdir, scan, manifest) and \
+               (store is None or store.linked(self, scan.lstat(self.path))):
                 log.progress('%s already up to date...' % self.path)
+                self.settle(destdir + self.path)
                 return False
             else:
                 path = destdir + self.path
+                scan.mkdirs(os.path.dirname(self.path))
+                if store is not None:
+                    log.progress('linking file %s...' % path)
+                    st = store.link(self, path, batch)
+                    self.settle(path)
+                    if manifest is not None:
+                        manifest.record(self.path, st, self.sha1())
+                    return True
+                if self.spilled is not None:
+                    log.progress('moving spilled file %s...' % path)
+                    tmp = batch.tmpname(path) if batch is not None else path
+                    self.move(tmp)
+                    self.spool.release(self.spilled)
+                    if batch is not None:
+                        batch.add(tmp, path)
+                    self.spilled = path
+                    if manifest is not None:
+                        manifest.record(self.path, os.stat(tmp), self.sha1())
+                    return True
                 log.progress('writing file %s...' % path)
-                os.makedirs(os.path.dirname(path), 0o755, True)
+                # never write through a link shared with other trees
+                st = scan.lstat(self.path)
+                if batch is None and st is not None and st.st_nlink > 1:
+                    os.unlink(path)
                 flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
                 mode = self.mode
-                fd = os.open(path, flags, mode)
-                os.write(fd, bytearray(self.content(), 'ascii'))
+                if batch is not None:
+                    tmp = batch.tmpname(path)
+                    fd = os.open(tmp, flags, mode)
+                    batch.add(tmp, path)
+                else:
+                    fd = os.open(path, flags, mode)
+                os.write(fd, self.data())
+                if manifest is not None:
+                    manifest.record(self.path, os.fstat(fd), self.sha1())
                 os.close(fd)
                 return True
 
     class IniFile(File):
-        def __init__(self, path, mode):
+        """
+        A file of [sections] with ordered name=value entries. Entries
+        are appended to their section as they are written and the file
+        is serialized only once. Keys listed as repeated may occur any
+        number of times, for other keys the duplicates policy decides:
+        allow appends, replace overwrites the earlier value in place and
+        error raises.
+        """
+
+        DUPLICATES = ['allow', 'replace', 'error']
+
+        def __init__(self, path, mode, canonical = False,
+                     duplicates = 'allow', repeated = []):
+            if duplicates not in CfgFS.IniFile.DUPLICATES:
+                raise RuntimeError('unknown duplicate key policy %s' %
+                                   duplicates)
             self.path = path
             self.mode = mode
+            self.canonical = canonical
+            self.duplicates = duplicates
+            self.repeated = repeated
+            self.owners = []
             self.csum = None
+            self.buf = None
+            self.spilled = None
             self.sections = {}
+            self.keys = {}
             self.prevkey = None
 
         def write(self, buf, key=None, end='\n'):
@@ -67,83 +815,231 @@ class CfgFS:
                 key = self.prevkey
             else:
                 self.prevkey = key
-            if key not in self.sections.keys():
-                self.sections[key] = buf + end
-            else:
-                self.sections[key] += buf + end
-            self.csum = None
+            lines = (buf + end).split('\n')
+            if lines[-1] == '':
+                lines.pop()
+            for line in lines:
+                if '=' in line and line[0:1] not in ['#', ';']:
+                    name, value = line.split('=', 1)
+                    self.add(key, name, value)
+                else:
+                    self.section(key).append((None, line))
+            self.csum = self.buf = None
+
+        def section(self, key):
+            if key not in self.sections:
+                self.sections[key] = []
+                self.keys[key] = {}
+            return self.sections[key]
+
+        def add(self, key, name, value):
+            entries = self.section(key)
+            keys = self.keys[key]
+            if name in keys and name not in self.repeated:
+                if self.duplicates == 'error':
+                    raise RuntimeError('%s: duplicate key %s in section [%s]' %
+                                       (self.path, name, key))
+                if self.duplicates == 'replace':
+                    entries[keys[name]] = (name, value)
+                    self.csum = self.buf = None
+                    return
+            keys[name] = len(entries)
+            entries.append((name, value))
+            self.csum = self.buf = None
+
+        def values(self, key, name):
+            return [v for n, v in self.sections.get(key, []) if n == name]
+
+        def text(self, entries):
+            return ''.join((line if name is None else name + '=' + line) +
+                           '\n' for name, line in entries)
 
         def close(self):
             self.prevkey = None
 
-        def content(self):
-            nl = buf = ''
-            for key, val in self.sections.items():
-                buf += nl + '[' + key + ']\n' + val
-                nl = '\n'
-            return buf
+        def data(self):
+            # sections are interleaved, materialize and hash only once
+            if self.buf is None:
+                chunks = []
+                sections = self.sections.items()
+                if self.canonical:
+                    sections = sorted(sections)
+                for key, entries in sections:
+                    if chunks:
+                        chunks.append('\n')
+                    chunks.append('[' + key + ']\n')
+                    chunks.append(self.text(entries))
+                self.buf = bytes(''.join(chunks), 'ascii')
+            return self.buf
+
+        @property
+        def size(self):
+            return len(self.data())
+
+        def sha1(self):
+            if not self.csum:
+                self.csum = sha1(self.data()).hexdigest()
+            return self.csum
+
+        def state(self):
+            sections = [(k, self.text(v)) for k, v in self.sections.items()]
+            return { 'type': 'ini', 'path': self.path, 'mode': self.mode,
+                     'sections': sections }
 
     class Dir:
         def __init__(self, path, mode):
             self.path = path
             self.mode = mode
+            self.owners = []
 
-        def checkfs(self, destdir):
-            path = destdir + self.path
-            return os.access(path, os.R_OK | os.W_OK | os.X_OK)
+        def state(self):
+            return { 'type': 'dir', 'path': self.path, 'mode': self.mode }
+
+        def node(self):
+            return { 'type': 'dir', 'mode': self.mode }
 
-        def commit(self, destdir):
-            if self.checkfs(destdir):
+        def checkfs(self, destdir, scan = None, manifest = None):
+            scan = scan or CfgFS.Scan(destdir, [self.path])
+            st = scan.lstat(self.path)
+            return st is not None and stat.S_ISDIR(st.st_mode)
+
+        def commit(self, destdir, scan = None, manifest = None, batch = None):
+            scan = scan or CfgFS.Scan(destdir, [self.path])
+            path = destdir + self.path
+            if self.checkfs(destdir, scan):
                 log.progress('directory %s up-to-date...' % path)
+                scan.dirs.add(self.path)
                 return False
             else:
-                path = destdir + self.path
                 log.progress('creating directory %s...' % path)
-                os.makedirs(os.path.dirname(path), 0o755, True)
-                os.mkdir(path, self.mode, True)
+                scan.mkdirs(os.path.dirname(self.path))
+                # a file or link generated earlier in its place
+                if scan.lstat(self.path) is not None:
+                    os.unlink(path)
+                os.mkdir(path, self.mode)
+                scan.dirs.add(self.path)
+                scan.created.add(self.path)
                 return True
 
     class Link:
         def __init__(self, src, dst, symbolic = True):
             self.src = src
             self.dst = dst
+            self.path = dst
             self.symbolic = symbolic
+            self.owners = []
 
-        def checkfs(self, destdir):
-            path = destdir + self.dst
+        def state(self):
+            return { 'type': 'link', 'src': self.src, 'path': self.dst,
+                     'symbolic': self.symbolic }
+
+        def node(self):
+            kind = 'symlink' if self.symbolic else 'hardlink'
+            return { 'type': kind, 'target': self.src }
+
+        def checkfs(self, destdir, scan = None, manifest = None):
+            scan = scan or CfgFS.Scan(destdir, [self.dst])
             if self.symbolic:
-                try:
-                    src = os.readlink(path)
-                    return src == self.src
-                except:
-                    return False
+                return scan.readlink(self.dst) == self.src
             else:
+                dst = scan.lstat(self.dst)
+                if dst is None:
+                    return False
                 try:
-                    dst = os.stat(path)
-                    src = os.stat(self.stc)
-                    return src.st_dev == dst.st_dev and src.st_ino == dst.st_int
-                except:
+                    src = os.stat(self.src)
+                    return src.st_dev == dst.st_dev and src.st_ino == dst.st_ino
+                except OSError:
                     return False
 
-        def commit(self, destdir):
+        def commit(self, destdir, scan = None, manifest = None, batch = None):
+            scan = scan or CfgFS.Scan(destdir, [self.dst])
             kind = 'symbolic ' if self.symbolic else 'hard '
-            if self.checkfs(destdir):
+            if self.checkfs(destdir, scan):
                 log.progress('%slink %s up-to-date...' % (kind, self.dst))
                 return False
             else:
                 path = destdir + self.dst
                 log.progress('creating %slink %s -> %s...' %
                              (kind, self.src, path))
-                os.makedirs(os.path.dirname(path), 0o755, True)
+                scan.mkdirs(os.path.dirname(self.dst))
+                if batch is not None:
+                    tmp = batch.tmpname(path)
+                    if os.path.lexists(tmp):
+                        os.unlink(tmp)
+                    batch.add(tmp, path)
+                else:
+                    tmp = path
+                    if scan.lstat(self.dst) is not None:
+                        os.unlink(path)
                 if self.symbolic:
-                    os.symlink(self.src, path)
+                    os.symlink(self.src, tmp)
                 else:
-                    os.link(self.src, path)
+                    os.link(self.src, tmp)
                 return True
 
 
-    def __init__(self):
+    def __init__(self, canonical = False, spool = None):
+        # all entries by path, and entries indexed by kind
         self.files = {}
+        self.dirs = []
+        self.symlinks = {}
+        self.hardlinks = {}
+        self.regular = {}
+        self.owner = None
+        self.canonical = canonical
+        self.spool = spool
+        # tree committed by the previous run, and its files read per owner
+        self.prevdir = None
+        self.inputs = {}
+
+    def ordered(self, items, key = None):
+        # in canonical mode, order items independently of input order
+        if self.canonical:
+            return sorted(items, key = key)
+        return list(items)
+
+    def indexed(self, index):
+        if self.canonical:
+            return [index[k] for k in sorted(index.keys())]
+        return list(index.values())
+
+    def own(self, entry):
+        if self.owner is not None and self.owner not in entry.owners:
+            entry.owners.append(self.owner)
+        return entry
+
+    def owned(self, owner):
+        return [x for x in self.files.values() if owner in x.owners]
+
+    def previous(self, path):
+        """Read path as committed by the previous run, None if missing."""
+        data = None
+        if self.prevdir is not None:
+            try:
+                with open(os.path.join(self.prevdir, path.lstrip('/'))) as f:
+                    data = f.read()
+            except (OSError, UnicodeDecodeError):
+                data = None
+        if self.owner is not None:
+            digest = sha1(data.encode()).hexdigest() if data is not None \
+                else None
+            self.inputs.setdefault(self.owner, {})[path] = digest
+        return data
+
+    def restore(self, state):
+        kind = state['type']
+        if kind == 'dir':
+            return self.mkdir(state['path'], state['mode'])
+        if kind == 'link':
+            return self.link(state['src'], state['path'], state['symbolic'])
+        f = self.open(state['path'], kind == 'ini', state['mode'])
+        if kind == 'ini':
+            for key, val in state['sections']:
+                f.write(val, key, end = '')
+        else:
+            f.write(state['content'], end = '')
+        f.close()
+        return f
 
     def mkdir(self, path, mode=0o755):
         if not os.path.isabs(path):
@@ -154,19 +1050,24 @@ class CfgFS:
                 raise RuntimeError('existing %s not a directory' % path)
         else:
             d = self.files[path] = CfgFS.Dir(path, mode)
-        return d
+            bisect.insort(self.dirs, path)
+        return self.own(d)
 
-    def open(self, path, ini=False, mode=0o644):
+    def open(self, path, ini=False, mode=0o644, duplicates='allow',
+             repeated=[]):
         if not os.path.isabs(path):
             raise RuntimeError('path %s is not absolute' % path)
         if path in self.files:
             f = self.files[path]
         else:
             if ini:
-                f = self.files[path] = CfgFS.IniFile(path, mode)
+                f = self.files[path] = CfgFS.IniFile(path, mode,
+                                                     self.canonical,
+                                                     duplicates, repeated)
             else:
-                f = self.files[path] = CfgFS.File(path, mode)
-        return f
+                f = self.files[path] = CfgFS.File(path, mode, self.spool)
+            self.regular[path] = f
+        return self.own(f)
 
     def link(self, src, dst, symbolic = False):
         if not os.path.isabs(dst):
@@ -175,11 +1076,15 @@ class CfgFS:
             l = self.files[dst]
             if type(l) != CfgFS.Link or l.symbolic != symbolic:
                 raise RuntimeError('cannot create %slink %s -> %s, %s exists' %
-                                   ('symbolic ' if symlink else '',
+                                   ('symbolic ' if symbolic else '',
                                     l.src, l.dst, l.dst))
         else:
             l = self.files[dst] = CfgFS.Link(src, dst, symbolic)
-        return l
+            if symbolic:
+                self.symlinks[dst] = l
+            else:
+                self.hardlinks[dst] = l
+        return self.own(l)
 
     def hardlink(self, src, dst):
         return self.link(src, dst, False)
@@ -187,55 +1092,236 @@ class CfgFS:
     def symlink(self, src, dst):
         return self.link(src, dst, True)
 
-    def create_dirs(self, destdir):
+    def entries(self):
+        if self.canonical:
+            return [self.files[k] for k in sorted(self.files.keys())]
+        return list(self.files.values())
+
+    def tree(self):
+        """Return the generated entries as a path -> node mapping."""
+        return dict((k, self.files[k].node()) for k in sorted(self.files))
+
+    def archive(self, archive, prefix = ''):
+        """Stream the generated entries into archive, under prefix."""
+        prefix = '/' + prefix.strip('/') if prefix.strip('/') else ''
+        entries = {}
+        nlinks = {}
+        for l in self.hardlinks.values():
+            if l.src not in self.regular:
+                raise RuntimeError('cannot archive hardlink %s -> %s, ' \
+                                   'target not a generated file' %
+                                   (l.dst, l.src))
+            nlinks[l.src] = nlinks.get(l.src, 1) + 1
+        for path, v in self.files.items():
+            if path not in self.hardlinks:
+                entries[prefix + path] = v
+            # parent directories not created explicitly
+            dir = os.path.dirname(prefix + path)
+            while dir not in entries and dir != '/':
+                entries[dir] = None
+                dir = os.path.dirname(dir)
+
+        # parents sort before their children, hardlinks after their targets
+        for path in sorted(entries.keys(), key = lambda x: x.split('/')):
+            v = entries[path]
+            if v is None:
+                archive.add_dir(path, 0o755)
+            elif type(v) == CfgFS.Dir:
+                archive.add_dir(path, v.mode)
+            elif type(v) == CfgFS.Link:
+                archive.add_symlink(path, v.src)
+            else:
+                archive.add_file(path, v.mode, v.data(),
+                                 nlinks.get(v.path, 1))
+        for l in sorted(self.hardlinks.values(),
+                        key = lambda x: x.dst.split('/')):
+            archive.add_hardlink(prefix + l.dst, prefix + l.src)
+
+    def create_dirs(self, destdir, scan = None, changes = None):
         created = False
-        dirs = []
-        for k, v in self.files.items():
-            if type(v) == CfgFS.Dir and v not in dirs:
-                dirs.append(v)
-        for d in sorted(dirs, key = lambda x: x.path):
-            if d.commit(destdir):
+        for path in self.dirs:
+            d = self.files[path]
+            existed = scan is not None and scan.lstat(path) is not None
+            changed = d.commit(destdir, scan)
+            if changed:
                 created = True
+            if changes is not None:
+                changes.track(d, existed, changed)
         return created
             
-    def create_symlinks(self, destdir):
-        created = False
-        symlinks = []
-        for k, v in self.files.items():
-            if type(v) == CfgFS.Link and v.symbolic and v not in symlinks:
-                symlinks.append(v)
-        for l in symlinks:
-            if l.commit(destdir):
-                created = True
-        return created
+    def commit_entries(self, entries, jobs, fn, changes = None, scan = None):
+        if changes is not None:
+            commit = fn
+            fn = lambda x: changes.track(x, scan.lstat(x.path) is not None,
+                                         commit(x))
+        # entries of a single phase are independent of each other
+        if jobs > 1 and len(entries) > 1:
+            with ThreadPoolExecutor(jobs) as executor:
+                results = list(executor.map(fn, entries))
+        else:
+            results = [fn(x) for x in entries]
+        return any(results)
 
-    def create_files(self, destdir):
-        created = False
-        for k, v in self.files.items():
-            if type(v) in [CfgFS.File, CfgFS.IniFile]:
-                if v.commit(destdir):
-                    created = True
-        return created
+    def create_symlinks(self, destdir, scan = None, batch = None, jobs = 1,
+                        changes = None):
+        symlinks = self.indexed(self.symlinks)
+        return self.commit_entries(symlinks, jobs,
+                                   lambda x: x.commit(destdir, scan,
+                                                      None, batch),
+                                   changes, scan)
+
+    def create_files(self, destdir, scan = None, manifest = None,
+                     batch = None, jobs = 1, store = None, changes = None):
+        files = self.indexed(self.regular)
+        updated = self.commit_entries(files, jobs,
+                                      lambda x: x.commit(destdir, scan,
+                                                         manifest, batch,
+                                                         store),
+                                      changes, scan)
+        if store is not None:
+            store.save(destdir, [store.key(x) for x in files])
+        if manifest is not None:
+            self.remove_files(destdir, manifest, batch, changes)
+        return updated
+
+    def remove_files(self, destdir, manifest, batch = None, changes = None):
+        # files written earlier but not generated any more
+        for path in sorted(manifest.old.keys()):
+            # still generated, possibly as a directory or link
+            if path in self.files:
+                continue
+            if changes is not None:
+                changes.record(path, CfgFS.ChangeSet.REMOVED)
+            log.progress('removing stale file %s%s...' % (destdir, path))
+            if batch is not None:
+                batch.remove(destdir + path)
+            else:
+                CfgFS.unlink(destdir + path)
 
-    def commit(self, destdir = '/'):
+    @staticmethod
+    def unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def link_previous(self, f, prevdir, destdir, scan, manifest):
+        path = destdir + f.path
+        log.progress('linking unchanged file %s...' % path)
+        scan.mkdirs(os.path.dirname(f.path))
+        os.link(prevdir + f.path, path)
+        f.settle(path)
+        manifest.record(f.path, os.stat(path), f.sha1())
+        return False
+
+    def commit_generation(self, destdir, keep, jobs = 1, store = None):
+        gens = CfgFS.Generations(destdir)
+        changes = CfgFS.ChangeSet()
+        prev = gens.current()
+        prevdir = None
+        unchanged = set()
+        existing = set()
+        if prev is not None:
+            prevdir = gens.path(prev)
+            scan = CfgFS.Scan(prevdir, self.files.keys())
+            manifest = CfgFS.Manifest(prevdir)
+            for v in self.entries():
+                if scan.lstat(v.path) is not None:
+                    existing.add(v)
+                if v.checkfs(prevdir, scan, manifest):
+                    unchanged.add(v)
+            for path in manifest.old.keys():
+                if path not in self.files:
+                    changes.record(path, CfgFS.ChangeSet.REMOVED)
+        for v in self.entries():
+            changes.track(v, v in existing, v not in unchanged)
+        if prev is not None and not changes:
+            log.progress('generation %d up-to-date...' % prev)
+            for f in self.regular.values():
+                f.settle(prevdir + f.path)
+            if self.spool is not None:
+                self.spool.cleanup()
+            gens.prune(keep)
+            return changes
+
+        gen = max(gens.list() + [0]) + 1
+        gendir = gens.path(gen)
+        log.progress('creating generation %d...' % gen)
+        if os.path.lexists(gendir):
+            shutil.rmtree(gendir)
+        os.makedirs(gendir, 0o755)
+
+        # hardlink unchanged files from the previous generation
+        scan = CfgFS.Scan(gendir, [])
+        manifest = CfgFS.Manifest(gendir)
+        files = self.indexed(self.regular)
+        self.create_dirs(gendir, scan)
+        self.create_symlinks(gendir, scan, None, jobs)
+        self.commit_entries(files, jobs,
+                            lambda x: self.link_previous(x, prevdir, gendir,
+                                                         scan, manifest)
+                            if x in unchanged else
+                            x.commit(gendir, scan, manifest, None, store))
+        if store is not None:
+            store.save(gendir, [store.key(x) for x in files])
+        manifest.save()
+
+        if self.spool is not None:
+            self.spool.cleanup()
+        syncfs(gendir)
+        gens.switch(gen)
+        gens.prune(keep)
+        return changes
+
+    def commit(self, destdir = '/', atomic = False, jobs = 1, generations = 0,
+               store = None):
         if not destdir.startswith('/'):
             raise RuntimeError('destdir (%s) is not absolute' % destdir)
         destdir = '/' + destdir.strip('/')
-        updated = False
-        if self.create_dirs(destdir):
-            updated = True
-        if self.create_symlinks(destdir):
-            updated = True
-        if self.create_files(destdir):
-            updated = True
-        return updated
+        if generations:
+            return self.commit_generation(destdir, generations, jobs, store)
+        changes = CfgFS.ChangeSet()
+        scan = CfgFS.Scan(destdir, self.files.keys())
+        batch = CfgFS.Batch(destdir) if atomic else None
+        self.create_dirs(destdir, scan, changes)
+        self.create_symlinks(destdir, scan, batch, jobs, changes)
+        manifest = CfgFS.Manifest(destdir)
+        self.create_files(destdir, scan, manifest, batch, jobs, store, changes)
+        if batch is not None:
+            batch.finish(scan)
+        if self.spool is not None:
+            self.spool.cleanup()
+        manifest.save()
+        return changes
+
+    def plan(self, destdir = '/'):
+        """Compute the change set of a commit to destdir, without writing."""
+        destdir = '/' + destdir.strip('/')
+        changes = CfgFS.ChangeSet()
+        scan = CfgFS.Scan(destdir, self.files.keys())
+        manifest = CfgFS.Manifest(destdir)
+        for v in self.entries():
+            st = scan.lstat(v.path)
+            changed = not v.checkfs(destdir, scan, manifest)
+            if v.path in self.regular:
+                old = 0 if st is None or stat.S_ISLNK(st.st_mode) else \
+                    st.st_size
+                changes.track(v, st is not None, changed, v.size - old)
+            else:
+                changes.track(v, st is not None, changed)
+        for path, entry in manifest.old.items():
+            if path not in self.files:
+                changes.record(path, CfgFS.ChangeSet.REMOVED, [], -entry[0])
+        return changes
 
     def checkfs(self, destdir = '/'):
         if not destdir.startswith('/'):
             raise RuntimeError('destdir (%s) is not absolute' % destdir)
         destdir = '/' + destdir.strip('/')
+        manifest = CfgFS.Manifest(destdir)
+        scan = CfgFS.Scan(destdir, self.files.keys())
         for k, v in self.files.items():
-            if not v.checkfs(destdir):
+            if not v.checkfs(destdir, scan, manifest):
                 return False
             else:
                 log.info('%s already up to date...' % k)
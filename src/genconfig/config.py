@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
-import sys, os, argparse
+import sys, os, json, fnmatch, argparse, threading
+from concurrent.futures import ThreadPoolExecutor
 import genconfig.log as log
 import genconfig.parser as parser
 import genconfig.cfgfs as cfgfs
+import genconfig.cache as cache
 
 DESCRIPTION = '''
 Reads a configuration file in reduced configuration syntax and generates
@@ -11,11 +13,28 @@ the corresponding set of standard component-specific full configuration
 files.
 '''
 
+GENCFG_DATA_DIR = '/usr/share/gen-config'
+
 HELP_CONFIG  = 'reduced configuration file to process'
-HELP_PROFILE = 'configuration profile to use'
+HELP_PROFILE = 'configuration profile(s) to use'
 HELP_DESTDIR = 'directory to generate configuration in'
 HELP_VERBOSE = 'increase logging verbosity'
 HELP_DEBUG   = 'enable debugging for given site'
+HELP_INCREMENTAL = 'skip generators with unchanged inputs'
+HELP_EXPLAIN = 'explain why generators were run or skipped'
+HELP_CANONICAL = 'generate output independent of input order'
+HELP_ATOMIC  = 'replace changed files atomically and durably'
+HELP_JOBS    = 'number of files to commit in parallel'
+HELP_GENERATIONS = 'commit into versioned generations, keeping this many'
+HELP_ARCHIVE = 'stream configuration into archive file (- for stdout)'
+HELP_FORMAT  = 'archive format'
+HELP_STORE   = 'link files from a shared content-addressed store'
+HELP_REFLINK = 'reflink instead of hardlink files from the store'
+HELP_STORE_GC = 'remove unreferenced objects from the store'
+HELP_STORE_STATS = 'show store deduplication statistics'
+HELP_CHANGES = 'write the change set and units to reload to file (JSON)'
+HELP_SPILL   = 'spill files larger than this many bytes to disk'
+HELP_PLAN    = 'show what would change in destdir, without writing'
 
 
 class Cfg:
@@ -25,12 +44,93 @@ class Cfg:
 
     DEFAULT_PROFILE = 'gateway'
 
+    class Profile:
+        """
+        Generation state for a single profile.
+        """
+
+        def __init__(self, name, destdir, *, cache_path = None,
+                     explain = False, canonical = False, atomic = False,
+                     jobs = 1, generations = 0, store = None, spill = 0):
+            self.name = name
+            self.destdir = destdir
+            self.atomic = atomic
+            self.jobs = jobs
+            self.generations = generations
+            self.store = store
+            self.changes = None
+            if spill and destdir:
+                spool = cfgfs.CfgFS.Spool(destdir, spill)
+            else:
+                spool = None
+            self.cfgfs = cfgfs.CfgFS(canonical, spool)
+            if destdir:
+                self.cfgfs.prevdir = self.current()
+            if cache_path:
+                self.cache = cache.Cache(cache_path, name, explain)
+            else:
+                self.cache = None
+
+        def generate(self, nodes):
+            for name, nodedef in nodes.items():
+                self.cfgfs.owner = name
+                if self.cache and nodedef.generate and \
+                   self.cache.reuse(nodedef, self.cfgfs):
+                    continue
+                nodedef.generate_config(self.cfgfs)
+            self.cfgfs.owner = None
+
+        def write(self):
+            self.changes = self.cfgfs.commit(self.destdir, self.atomic,
+                                             self.jobs, self.generations,
+                                             self.store)
+            if self.cache:
+                self.cache.save(self.cfgfs)
+            return self.changes
+
+        def units(self, nodes):
+            # units whose inputs were changed by their owning generators
+            units = set()
+            for path in self.changes.changed():
+                # removed paths have no owner left, try all generators
+                owners = self.changes.owners(path) or nodes.keys()
+                for owner in owners:
+                    for pattern, unit in nodes[owner].units:
+                        if fnmatch.fnmatch(path, pattern):
+                            units.add(unit)
+            return sorted(units)
+
+        def checkfs(self):
+            return self.cfgfs.checkfs(self.destdir)
+
+        def cleanup(self):
+            if self.cfgfs.spool is not None:
+                self.cfgfs.spool.cleanup()
+
+        def current(self):
+            # the tree committed by the last run
+            if self.generations:
+                gens = cfgfs.CfgFS.Generations(self.destdir)
+                current = gens.current()
+                if current is not None:
+                    return gens.path(current)
+            return self.destdir
+
+        def plan(self):
+            self.changes = self.cfgfs.plan(self.current())
+            return self.changes
+
     def __init__(self, dir, argv):
         self.dir = dir
         self.parse_cmdline(argv)
         self.config_file = self.args.config_file
         self.dest_dir = self.args.destdir
-        self.profile = self.args.profile
+        self.profile = self.args.profile[0]
+
+        # keep stdout clean for the archive
+        if self.args.archive == '-':
+            self.stdout = sys.stdout.buffer
+            sys.stdout = sys.stderr
 
         if self.args.verbose is not None:
             for i in range(0, self.args.verbose):
@@ -46,11 +146,37 @@ class Cfg:
                     for s in site.split(','):
                         log.debug_enable(s)
 
-        sys.path.insert(0, os.path.join(self.dir, 'profiles'))
-        print('added load path %s' % os.path.join(self.dir, 'profiles'))
+        if self.args.store:
+            self.store = cfgfs.CfgFS.Store(self.args.store, self.args.reflink)
+        else:
+            self.store = None
 
-        self.parser = parser.Parser(self.profile, self.config_file)
-        self.cfgfs = cfgfs.CfgFS()
+        self.parser = parser.Parser(self.profile, self.config_file,
+                                    profile_dir = os.path.join(self.dir,
+                                                               'profiles'))
+        self.profiles = []
+        for p in self.args.profile:
+            destdir = self.destdir(p)
+            if self.args.incremental or self.args.explain:
+                cache_path = self.cache_path(destdir)
+            else:
+                cache_path = None
+            if self.args.archive or self.args.plan:
+                spill = 0
+            else:
+                spill = self.args.spill_threshold
+            args = self.args
+            self.profiles.append(Cfg.Profile(p, destdir,
+                                             cache_path = cache_path,
+                                             explain = args.explain,
+                                             canonical = args.canonical,
+                                             atomic = args.atomic,
+                                             jobs = args.jobs,
+                                             generations = args.generations,
+                                             store = self.store,
+                                             spill = spill))
+        self.cfgfs = self.profiles[0].cfgfs
+        self.cache = self.profiles[0].cache
 
     def parse_cmdline(self, argv):
         ap = argparse.ArgumentParser(prog = argv[0], description = DESCRIPTION)
@@ -60,26 +186,198 @@ class Cfg:
         ap.add_argument('-d', '--debug'  , help = HELP_DEBUG,
                         action = 'append', nargs = '?', const = None)
         ap.add_argument('-P', '--profile', help = HELP_PROFILE,
-                        default = Cfg.DEFAULT_PROFILE)
+                        action = 'append', default = None)
         ap.add_argument('-D', '--destdir', help = HELP_DESTDIR, default = None)
+        ap.add_argument('-I', '--incremental', help = HELP_INCREMENTAL,
+                        action = 'store_true')
+        ap.add_argument('--explain', help = HELP_EXPLAIN,
+                        action = 'store_true')
+        ap.add_argument('--canonical', help = HELP_CANONICAL,
+                        action = 'store_true')
+        ap.add_argument('--atomic', help = HELP_ATOMIC,
+                        action = 'store_true')
+        ap.add_argument('-j', '--jobs', help = HELP_JOBS, type = int,
+                        default = 1)
+        ap.add_argument('-G', '--generations', help = HELP_GENERATIONS,
+                        type = int, default = 0)
+        ap.add_argument('-A', '--archive', help = HELP_ARCHIVE, default = None)
+        ap.add_argument('--format', help = HELP_FORMAT, default = 'tar',
+                        choices = cfgfs.CfgFS.Archive.FORMATS)
+        ap.add_argument('-S', '--store', help = HELP_STORE, default = None)
+        ap.add_argument('--reflink', help = HELP_REFLINK,
+                        action = 'store_true')
+        ap.add_argument('--store-gc', help = HELP_STORE_GC,
+                        action = 'store_true')
+        ap.add_argument('--store-stats', help = HELP_STORE_STATS,
+                        action = 'store_true')
+        ap.add_argument('--changes', help = HELP_CHANGES, default = None)
+        ap.add_argument('--spill-threshold', help = HELP_SPILL, type = int,
+                        default = 0)
+        ap.add_argument('--plan', help = HELP_PLAN, action = 'store_true')
         self.args = ap.parse_args(argv[1:])
+        profiles = []
+        for p in self.args.profile or [Cfg.DEFAULT_PROFILE]:
+            for name in p.split(','):
+                if name and name not in profiles:
+                    profiles.append(name)
+        self.args.profile = profiles
+
+    def destdir(self, profile):
         if not self.args.destdir:
             base = os.path.basename(self.args.config_file).split('.')[0]
-            self.args.destdir = os.path.abspath('out/%s/%s' %
-                                                (base, self.args.profile))
+            return os.path.abspath('out/%s/%s' % (base, profile))
+        if len(self.args.profile) > 1:
+            return os.path.join(os.path.abspath(self.args.destdir), profile)
+        return self.args.destdir
+
+    def cache_path(self, destdir):
+        return cfgfs.state_path(destdir, '.gen-config-cache')
+
+    def check_profiles(self):
+        # the parse is shared only by profiles which use the same modules
+        for p in self.profiles[1:]:
+            for name, module in self.parser.modules.items():
+                if self.parser.find_module(name, p.name) != module:
+                    raise RuntimeError(('profile %s overrides module %s, ' +
+                                        'it cannot share the parse of ' +
+                                        'profile %s') %
+                                       (p.name, name, self.profile))
 
     def parse(self):
         self.cfg = self.parser.parse()
+        self.check_profiles()
 
     def dump(self):
         self.cfg.dump()
 
+    def run(self, fn):
+        if len(self.profiles) == 1:
+            return [fn(self.profiles[0])]
+        with ThreadPoolExecutor(len(self.profiles)) as executor:
+            return list(executor.map(fn, self.profiles))
+
     def generate(self):
-        for name, nodedef in self.parser.nodes.items():
-            nodedef.generate_config(self.cfgfs)
+        self.run(lambda p: p.generate(self.parser.nodes))
 
     def write(self):
-        return self.cfgfs.commit(self.args.destdir)
+        if self.args.archive:
+            return self.archive()
+        updated = any(self.run(lambda p: p.write()))
+        if self.store and self.args.store_gc:
+            removed, freed = self.store.gc()
+            log.progress('removed %d unreferenced objects (%d bytes)' %
+                         (removed, freed))
+        if self.store and self.args.store_stats:
+            stats = self.store.stats()
+            log.progress(('store: %(objects)d objects, %(references)d ' +
+                          'references, %(unique)d bytes for %(logical)d ' +
+                          'bytes of content (%(ratio).2fx), %(written)d ' +
+                          'bytes written, %(reused)d bytes reused') % stats)
+        for p in self.profiles:
+            units = p.units(self.parser.nodes)
+            if units:
+                log.progress('%s: units to reload: %s' %
+                             (p.name, ', '.join(units)))
+        if self.args.changes:
+            self.save_changes(self.args.changes)
+        return updated
+
+    def save_changes(self, path):
+        changes = {}
+        for p in self.profiles:
+            changes[p.name] = { 'destdir': p.destdir,
+                                'paths': p.changes.state(),
+                                'units': p.units(self.parser.nodes) }
+        with open(path, 'w') as f:
+            json.dump(changes, f, indent = 2, sort_keys = True)
+
+    def archive(self):
+        if self.args.archive == '-':
+            f = self.stdout
+        else:
+            f = open(self.args.archive, 'wb')
+        try:
+            archive = cfgfs.CfgFS.Archive(f, self.args.format)
+            for p in self.profiles:
+                if len(self.profiles) > 1:
+                    p.cfgfs.archive(archive, p.name)
+                else:
+                    p.cfgfs.archive(archive)
+            archive.close()
+        finally:
+            if self.args.archive != '-':
+                f.close()
+        return True
 
     def checkfs(self):
-        return self.cfgfs.checkfs(self.args.destdir)
+        return all(self.run(lambda p: p.checkfs()))
+
+    def cleanup(self):
+        # remove files spilled but never committed, e.g. after a failure
+        for p in self.profiles:
+            p.cleanup()
+
+    def plan(self):
+        changed = any(self.run(lambda p: p.plan()))
+        for p in self.profiles:
+            counts = {}
+            added = removed = 0
+            for path in p.changes.paths():
+                status = p.changes.status(path)
+                delta = p.changes.delta(path) or 0
+                counts[status] = counts.get(status, 0) + 1
+                if delta > 0:
+                    added += delta
+                else:
+                    removed -= delta
+                if status != cfgfs.CfgFS.ChangeSet.UNCHANGED:
+                    log.progress('%s: %s %s (%+d bytes)' %
+                                 (p.name, status, path, delta))
+            log.progress(('%s: %d added, %d modified, %d removed, ' +
+                          '%d unchanged, +%d/-%d bytes') %
+                         (p.name, counts.get('added', 0),
+                          counts.get('modified', 0), counts.get('removed', 0),
+                          counts.get('unchanged', 0), added, removed))
+            units = p.units(self.parser.nodes)
+            if units:
+                log.progress('%s: units to reload: %s' %
+                             (p.name, ', '.join(units)))
+        if self.args.changes:
+            self.save_changes(self.args.changes)
+        return changed
+
+
+def data_dir():
+    # prefer profiles next to the package when running from the source tree
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if os.path.isdir(os.path.join(src_dir, 'profiles')):
+        return src_dir
+    return GENCFG_DATA_DIR
+
+render_lock = threading.Lock()
+
+def render(config = None, text = None, profile = Cfg.DEFAULT_PROFILE,
+           dir = None, canonical = False):
+    """
+    Generate configuration in memory. Renders are serialized, concurrent
+    calls wait for each other.
+
+    Parse the configuration file config, or the configuration given as
+    text, and generate it for profile. Nothing is written to the disk
+    and no logging is done. Returns the generated tree as a mapping of
+    absolute paths to nodes: { 'type': 'file', 'mode': mode, 'data':
+    bytes }, { 'type': 'dir', 'mode': mode } or { 'type': 'symlink' or
+    'hardlink', 'target': path }.
+    """
+    if (config is None) == (text is None):
+        raise RuntimeError('exactly one of config and text must be given')
+    profile_dir = os.path.join(dir or data_dir(), 'profiles')
+
+    # parser and node definitions are global and generators read them
+    # while generating, so the whole parse and generation is serialized
+    with render_lock, log.silenced():
+        p = parser.Parser(profile, config or '<text>', text, profile_dir)
+        p.parse()
+        target = Cfg.Profile(profile, None, canonical = canonical)
+        target.generate(p.nodes)
+        return target.cfgfs.tree()
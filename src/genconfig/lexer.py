@@ -15,7 +15,7 @@
 # A token is a whitespace separated sequence, with the exception that
 # a comma is always a token of its own.
 
-import sys, importlib, os, re
+import sys, io, importlib, importlib.util, os, re
 import genconfig.log as log
 
 class TokenSet():
@@ -74,15 +74,20 @@ class TokenSet():
 class Lexer(TokenSet):
     """A class for reduced configuration lexical analysis."""
 
-    active_keywords = []
-    active_tokens = []
     regexp_type = type(re.compile(''))
 
-    def __init__(self, profile, path):
+    # node definitions made by the module being loaded
+    loading = None
+
+    def __init__(self, profile, path, text = None, profile_dir = None):
         self.profile = profile
+        self.profile_dir = profile_dir
+        self.modules = {}
         self.files = []
         self.tokenq = []
-        self.include_file(path)
+        self.active_keywords = []
+        self.active_tokens = []
+        self.include_file(path, text = text)
 
     def tokenize(self):
         while self.files:
@@ -104,12 +109,15 @@ class Lexer(TokenSet):
     def load_module(self, name):
         profiles = [ self.profile, 'common' ]
         for p in [self.profile, 'common']:
-            m = p + '.modules.' + name
+            m = self.module_name(p, name)
             if m in sys.modules:
+                self.register_module(sys.modules[m])
+                self.modules[name] = m
                 return
             log.progress('looking for module %s in %s profile' % (name, p))
             try:
-                sys.modules[m] = importlib.import_module(m)
+                sys.modules[m] = self.import_module(m, p, name)
+                self.modules[name] = m
                 return
             except ImportError as e:
                 pass
@@ -118,17 +126,79 @@ class Lexer(TokenSet):
     def try_module(self, name):
         profiles = [ self.profile, 'common' ]
         for p in [self.profile, 'common']:
-            m = p + '.modules.' + name
+            m = self.module_name(p, name)
             if m in sys.modules:
-                return
+                self.register_module(sys.modules[m])
+                self.modules[name] = m
+                return True
             log.progress('looking for module %s in %s profile' % (name, p))
             try:
-                sys.modules[m] = importlib.import_module(m)
+                sys.modules[m] = self.import_module(m, p, name)
+                self.modules[name] = m
                 return True
             except ImportError as e:
                 pass
         return False
 
+    def find_module(self, name, profile):
+        """Find the module a profile would use without loading it."""
+        for p in [profile, 'common']:
+            m = self.module_name(p, name)
+            if m in sys.modules:
+                return m
+            if self.profile_dir is not None:
+                if os.path.exists(self.module_path(p, name)):
+                    return m
+                continue
+            try:
+                if importlib.util.find_spec(m) is not None:
+                    return m
+            except ImportError as e:
+                pass
+        return None
+
+    def module_name(self, profile, name):
+        # modules of a profile directory are named after its resolved path,
+        # so profiles from another directory never reuse them
+        m = profile + '.modules.' + name
+        if self.profile_dir is None:
+            return m
+        return '%s@%s' % (m, os.path.realpath(self.profile_dir))
+
+    def register_module(self, module):
+        # node definitions are dropped between parses, register them again
+        for nodedef in getattr(module, '__nodedefs__', []):
+            nodedef.register()
+
+    def module_path(self, profile, name):
+        return os.path.join(self.profile_dir, profile, 'modules', name + '.py')
+
+    def import_module(self, m, profile, name):
+        Lexer.loading = nodedefs = []
+        try:
+            module = self.exec_module(m, profile, name)
+        finally:
+            Lexer.loading = None
+        module.__nodedefs__ = nodedefs
+        return module
+
+    def exec_module(self, m, profile, name):
+        # without a profile directory, modules are looked up from sys.path
+        if self.profile_dir is None:
+            return importlib.import_module(m)
+        path = self.module_path(profile, name)
+        if not os.path.exists(path):
+            raise ImportError('module %s not found' % m)
+        spec = importlib.util.spec_from_file_location(m, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[m] = module
+        try:
+            spec.loader.exec_module(module)
+        except:
+            del sys.modules[m]
+            raise
+        return module
+
     def load_modules(self, input):
         for tkn in input:
             if tkn.level != -1:
@@ -140,7 +210,7 @@ class Lexer(TokenSet):
             else:
                 self.load_module(name)
 
-    def include_file(self, path, level = 0, parent_path = None):
+    def include_file(self, path, level = 0, parent_path = None, text = None):
         if not os.path.isabs(path) and parent_path is not None:
             path = os.path.join(os.path.dirname(parent_path), path)
 
@@ -149,7 +219,7 @@ class Lexer(TokenSet):
                 raise RuntimeError('recusive inclusion of %s (in %s)' %
                                    (path, parent_path))
 
-        self.files.append(Lexer.File(path, level))
+        self.files.append(Lexer.File(path, level, text))
 
     def pull_token(self, level = -1):
         if not self.tokenq:
@@ -332,12 +402,15 @@ class Lexer(TokenSet):
     class File:
         """A single input file, iterable for relevant input lines."""
 
-        def __init__(self, path, level = 0):
+        def __init__(self, path, level = 0, text = None):
             self.path = path
             self.level = level
             self.line = None
             self.lineno = 0
-            self.input = open(self.path, 'r')
+            if text is not None:
+                self.input = io.StringIO(text)
+            else:
+                self.input = open(self.path, 'r')
             self.pushedback = []
 
         def __iter__(self):
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import re, inspect
+import re, inspect, contextvars, contextlib
 
 class Logger:
     LOG_FATAL = 0
@@ -26,6 +26,9 @@ class Logger:
 
     log_unmaskable = (1 << LOG_FATAL) | (1 << LOG_ERROR)
     log_mask = log_unmaskable | (1 << LOG_WARNING)
+
+    # per-context mask overriding log_mask, see silenced()
+    local_mask = contextvars.ContextVar('local_mask', default = None)
     
     def __init__(self, levels = default_levels):
         log_set_mask(levels)
@@ -40,8 +43,21 @@ def set_mask(levels):
         Logger.log_mask |= 1 << levels
 
 
+def get_mask():
+    mask = Logger.local_mask.get()
+    return Logger.log_mask if mask is None else mask
+
+@contextlib.contextmanager
+def silenced(mask = 0):
+    """Override the log mask in the current context only."""
+    token = Logger.local_mask.set(mask)
+    try:
+        yield
+    finally:
+        Logger.local_mask.reset(token)
+
 def log(level, msg):
-    if Logger.log_mask & (1 << level):
+    if get_mask() & (1 << level):
         prefix = Logger.log_prefix[level]
         print('%s%s' % (prefix, msg))
 
@@ -73,7 +89,7 @@ def debug_enable(contexts):
 
     
 def debug_enabled(contexts):
-    if not Logger.log_mask & (1 << Logger.LOG_DEBUG):
+    if not get_mask() & (1 << Logger.LOG_DEBUG):
         return False
     if not contexts or not Logger.debug_contexts:
         return True
@@ -86,9 +102,13 @@ def debug_enabled(contexts):
 
 
 def debug(*args):
-    caller = inspect.stack()[1][3]
+    # bail out early, looking up the caller is expensive
+    if not get_mask() & (1 << Logger.LOG_DEBUG):
+        return
+    frame = inspect.currentframe().f_back
+    caller = frame.f_code.co_name
     if caller == 'debug':
-        caller = inspect.stack()[2][3]
+        caller = frame.f_back.f_code.co_name
     if type(args[0]) == type(''):
         contexts = [caller]
         msg = args[0]
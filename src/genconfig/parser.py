@@ -11,6 +11,7 @@ class Node:
         self.node_tkn = node_tkn
         self.parent = parent
         self.children = []
+        self.tokens = []
         self.nodedef.nodes.append(self)
         if parent:
             parent.children.append(self)
@@ -24,6 +25,22 @@ class Node:
             tkn = self.node_tkn
         return (tkn.file, tkn.line)
 
+    def digest(self, csum, ancestors = False):
+        parent = self.parent if ancestors else None
+        while parent:
+            for tkn in parent.tokens:
+                csum.update(tkn.str.encode() + b'\0')
+            csum.update(b'>')
+            parent = parent.parent
+        for tkn in self.tokens:
+            csum.update(tkn.str.encode() + b'\0')
+        csum.update(b'{')
+        for c in self.children:
+            # nodes with a generator of their own are digested separately
+            if not c.nodedef.generate:
+                c.digest(csum)
+        csum.update(b'}')
+
     def finalize(self):
         for c in self.children:
             c.finalize()
@@ -38,7 +55,7 @@ class Node:
 
 class NodeDef:
     def __init__(self, name, type, extra, keywords, tokens, rules,
-                 generate = None):
+                 generate = None, depends = [], units = []):
         self.name = name
         self.type = type
         self.extra_tokens = extra
@@ -46,11 +63,25 @@ class NodeDef:
         self.tokens = tokens
         self.rules = rules
         self.generate = generate
+        self.depends = depends
+        self.units = units
         self.nodes = []
-        Lexer.keywords[name] = keywords
-        Lexer.tokens[name] = tokens
-        Parser.rules[name] = rules
-        Parser.nodes[name] = self
+        self.register()
+        if Lexer.loading is not None:
+            Lexer.loading.append(self)
+
+    def register(self):
+        Lexer.keywords[self.name] = self.keywords
+        Lexer.tokens[self.name] = self.tokens
+        Parser.rules[self.name] = self.rules
+        Parser.nodes[self.name] = self
+
+    def unregister(self):
+        self.nodes = []
+        del Lexer.keywords[self.name]
+        del Lexer.tokens[self.name]
+        del Parser.rules[self.name]
+        del Parser.nodes[self.name]
 
     def generate_config(self, fs):
         if self.generate:
@@ -61,8 +92,8 @@ class RuleSet(Lexer):
     rules = {}
     nodes = {}
 
-    def __init__(self, profile, path):
-        Lexer.__init__(self, profile, path)
+    def __init__(self, profile, path, text = None, profile_dir = None):
+        Lexer.__init__(self, profile, path, text, profile_dir)
 
     def compile(self, rule):
         log.debug('compiling rule %s => %s' % (rule.pattern, rule.callback))
@@ -105,8 +136,18 @@ class Parser(RuleSet):
     A class for parsing files in reduced configuration format.
     """
 
-    def __init__(self, profile, path):
-        RuleSet.__init__(self, profile, path)
+    # node definitions not coming from profile modules
+    BUILTIN = ['root']
+
+    def __init__(self, profile, path, text = None, profile_dir = None):
+        RuleSet.__init__(self, profile, path, text, profile_dir)
+        # node definitions are global, drop the ones and the nodes of any
+        # earlier parse, modules loaded by this parse register theirs
+        for name, nodedef in list(self.nodes.items()):
+            if name in Parser.BUILTIN:
+                nodedef.nodes = []
+            else:
+                nodedef.unregister()
         self.root = Node(Parser.nodes['root'], None, None, None)
 
     def parse(self):
@@ -157,6 +198,7 @@ class Parser(RuleSet):
         extra = self.pull_tokens(node_tkn.level, nodedef.extra_tokens)
         root = self.root
         node = nodedef.type(nodedef, root, parent, node_tkn, *extra)
+        node.tokens = [node_tkn] + extra
         tokens = self.pull_tokens(node_tkn.level)
 
         log.debug('%s block: %s' %
@@ -202,6 +244,7 @@ class Parser(RuleSet):
                     RuntimeError('%s has no method %s' %
                                  (str(nodedef.type), rule.callback))
                 else:
+                    node.tokens += args
                     c(*args)
 
         self.pop_context()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+#
+# Compiled output templates for generators.
+#
+# A template is the literal output text with two extensions:
+#
+# - ${expr} is substituted with the value of a python expression
+# - lines starting with % are control lines: '% for ...:', '% if ...:',
+#   '% elif ...:', '% else:' and '% end' closing a for or if block
+#
+# Templates are compiled once when they are created (usually at module
+# load time) into a python function. Rendering calls that function which
+# appends the output line by line straight to a CfgFS file, so a large
+# output is never held as a single string and can spill to disk.
+
+import re, textwrap
+
+class Template:
+    """An output template compiled into a python render function."""
+
+    class Sink:
+        """The chunks of a rendering, written to a CfgFS file as they come."""
+
+        def __init__(self, f, section = None):
+            if section:
+                self.append = lambda chunk: f.write(chunk, section, end = '')
+            else:
+                self.append = lambda chunk: f.write(chunk, end = '')
+
+    EXPR = re.compile(r'\$\{([^}]*)\}')
+    OPENERS = ['for', 'if', 'while']
+    CONTINUATIONS = ['elif', 'else']
+
+    def __init__(self, params, text, name = None):
+        self.params = params
+        self.name = name or 'template'
+        self.text = textwrap.dedent(text).lstrip('\n')
+        self.source = self.translate()
+        namespace = {}
+        exec(compile(self.source, '<%s>' % self.name, 'exec'), {}, namespace)
+        self.fn = namespace['render']
+
+    def translate(self):
+        code = ['def render(__chunks, %s):' % self.params,
+                ' __a = __chunks.append']
+        depth = 1
+        for lineno, line in enumerate(self.text.splitlines(), 1):
+            stripped = line.strip()
+            if stripped.startswith('%'):
+                stmt = stripped[1:].strip()
+                kw = re.split(r'[ :]', stmt, 1)[0]
+                if kw == 'end':
+                    depth -= 1
+                    if depth < 1:
+                        raise RuntimeError('%s:%d: unbalanced %% end' %
+                                           (self.name, lineno))
+                elif kw in Template.CONTINUATIONS:
+                    code.append(' ' * (depth - 1) + stmt)
+                    code.append(' ' * depth + 'pass')
+                elif kw in Template.OPENERS:
+                    code.append(' ' * depth + stmt)
+                    depth += 1
+                    code.append(' ' * depth + 'pass')
+                else:
+                    raise RuntimeError('%s:%d: unknown directive %s' %
+                                       (self.name, lineno, kw))
+            else:
+                code.append(' ' * depth + self.translate_line(line))
+        if depth != 1:
+            raise RuntimeError('%s: unterminated block' % self.name)
+        return '\n'.join(code) + '\n'
+
+    def translate_line(self, line):
+        fmt = ''
+        args = []
+        pos = 0
+        for m in Template.EXPR.finditer(line):
+            fmt += line[pos:m.start()].replace('%', '%%') + '%s'
+            args.append('(%s),' % m.group(1))
+            pos = m.end()
+        fmt += line[pos:].replace('%', '%%') + '\n'
+        if not args:
+            return '__a(%s)' % repr(fmt.replace('%%', '%'))
+        return '__a(%s %% (%s))' % (repr(fmt), ' '.join(args))
+
+    def render(self, f, *args, section = None, **kwargs):
+        self.fn(Template.Sink(f, section), *args, **kwargs)
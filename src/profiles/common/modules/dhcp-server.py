@@ -3,12 +3,25 @@
 import ipaddress
 
 from genconfig.parser import *
+from genconfig.template import Template
 
 class DhcpServer(Node):
 
     V4_TYPE = type(ipaddress.ip_address('0.0.0.0'))
     SYSCONFIG = '/etc/sysconfig/dhcp-server'
     CONFIGFILE = '/etc/dhcp/dhcpd.conf'
+    SUBNET = Template('s, net, mask', '''
+        subnet ${net} netmask ${mask} {
+        % if s.domain:
+          option domain-name "${s.domain}";
+        % end
+          option domain-name-servers ${','.join([str(x) for x in s.nameservers])};
+          option routers ${s.router};
+          range ${s.range[0]} ${s.range[1]};
+          default-lease-time ${s.default_lease};
+          max-lease-time ${s.max_lease};
+        }
+        ''', 'dhcpd.conf subnet')
 
     def __init__(self, nodedef, root, parent, node_tkn):
         Node.__init__(self, nodedef, root, parent, node_tkn)
@@ -170,21 +183,12 @@ class DhcpServer(Node):
         log.progress('generating DHCP server for link %s...' % self.link)
         net, mask = self.net.with_netmask.split('/')
         f = fs.open(DhcpServer.CONFIGFILE)
-        f.write('subnet %s netmask %s {' % (net, mask))
-        if self.domain:
-            f.write('  option domain-name "%s";' % self.domain)
-        f.write('  option domain-name-servers %s;' %
-                ','.join([str(x) for x in self.nameservers]))
-        f.write('  option routers %s;' % self.router)
-        f.write('  range %s %s;' % (self.range[0], self.range[1]))
-        f.write('  default-lease-time %s;' % self.default_lease)
-        f.write('  max-lease-time %s;' % self.max_lease)
-        f.write('}')
+        DhcpServer.SUBNET.render(f, self, net, mask)
         f.close()
 
 def generate_dhcp_servers(nodedef, servers, fs):
     links = []
-    for s in servers:
+    for s in fs.ordered(servers, key = lambda x: (x.link, x.net)):
         s.generate(fs)
         links.append(s.link)
     f = fs.open(DhcpServer.SYSCONFIG)
@@ -206,5 +210,8 @@ NodeDef(
      Parser.Rule('_router_ _token_'                   , 'parse_router'),
      Parser.Rule('_nameservers_ (_int_|_address_|_router_)(, (_int_|_address_|_router_))*', 'parse_dns'),
      Parser.Rule('(_max-lease_|_default-lease_) _int_', 'parse_lease' )],
-    generate_dhcp_servers
+    generate_dhcp_servers,
+    depends = ['interface'],
+    units = [(DhcpServer.CONFIGFILE, 'dhcpd.service'),
+             (DhcpServer.SYSCONFIG , 'dhcpd.service')]
 )
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
-import ipaddress
+import ipaddress, difflib
 from genconfig.parser import *
+from genconfig.template import Template
 
 class IPTables:
     BUILTIN_CHAINS = {
@@ -12,9 +13,49 @@ class IPTables:
     }
     CONFIG_FILES = {
         'restore':  '/etc/sysconfig/iptables',
-        'iptables': '/etc/sysconfig/iptables-commands'
+        'iptables': '/etc/sysconfig/iptables-commands',
+        'ipset':    '/etc/sysconfig/ipset',
+        'delta':    '/etc/sysconfig/iptables-delta',
+        'nftables': '/etc/sysconfig/nftables.conf'
     }
 
+    # address lists longer than this are matched using an ipset
+    IPSET_THRESHOLD = 32
+
+    # packet mark bits used for the zones of isolated interfaces
+    ZONE_MASK = 0xffff0000
+    ZONE_SHIFT = 16
+
+    class IPSet:
+        """
+        An ipset of addresses or networks, matched in constant time. The
+        entries are restored into a new set swapped with the live one, so
+        removed entries are dropped; all sets are hash:net, which holds
+        addresses too, as swapping needs sets of the same type.
+        """
+        TYPE = 'hash:net'
+
+        def __init__(self, name, family, entries):
+            self.name = name
+            self.type = IPTables.IPSet.TYPE
+            self.family = family
+            self.entries = entries
+            self.maxelem = max(65536, len(entries))
+
+        RESTORE = Template('s', '''
+            create ${s.name} ${s.type} family ${s.family} maxelem ${s.maxelem}
+            create ${s.name}-new ${s.type} family ${s.family} maxelem ${s.maxelem}
+            flush ${s.name}-new
+            % for e in s.entries:
+            add ${s.name}-new ${e}
+            % end
+            swap ${s.name}-new ${s.name}
+            destroy ${s.name}-new
+            ''', 'ipset restore set')
+
+        def write_restore(self, f):
+            IPTables.IPSet.RESTORE.render(f, self)
+
     class Table:
         def __init__(self, name, chains = []):
             self.name = name
@@ -23,96 +64,489 @@ class IPTables:
 
             for c in chains:
                 if type(c) == type(''):
-                    self.chains.append(IPTables.Chain(c))
+                    self.chain(c)
                 else:
-                    self.chains.append(IPTables.Chain(c[0], c[1]))
+                    self.chain(c[0], c[1])
 
             if self.name in IPTables.BUILTIN_CHAINS.keys():
-                builtin = IPTables.BUILTIN_CHAINS[self.name]
-                for c in builtin:
-                    if c not in [x.name for x in self.chains]:
-                        self.chains.append(IPTables.Chain(c))
-
-            self.chain_index = {}
-            for idx in range(0, len(self.chains)):
-                self.chain_index[self.chains[idx].name] = idx
+                for c in IPTables.BUILTIN_CHAINS[self.name]:
+                    self.chain(c)
 
         def chain(self, name, policy = None):
-            if name not in [x.name for x in self.chains]:
+            c = self.chain_index.get(name)
+            if c is None:
                 c = IPTables.Chain(name, policy)
                 self.chains.append(c)
-                self.chain_index[name] = len(self.chains) - 1
-            else:
-                c = self.chains[self.chain_index[name]]
-                if policy and c.policy and policy != c.policy:
-                    raise RuntimeError('chain %s has conflicting policies' %
-                                       (c.name, c.policy, policy))
+                self.chain_index[name] = c
+            elif policy and c.policy and policy != c.policy:
+                raise RuntimeError('chain %s has conflicting policies %s, %s' %
+                                   (c.name, c.policy, policy))
             return c
 
+        RESTORE = Template('t, builtin, generator', '''
+            # ${t.name} configuration generated by ${generator}
+            *${t.name}
+            % for c in t.chains:
+            :${c.name} ${c.policy if c.name in builtin else '-'} [0:0]
+            % end
+            % for c in t.chains:
+            %   for r in c:
+            -A ${c.name} ${r}
+            %   end
+            % end
+            COMMIT
+            ''', 'iptables-restore table')
+
+        COMMANDS = Template('t, builtin, generator', '''
+            # ${t.name} commands generated by ${generator}
+            % for c in t.chains:
+            %   if c.name not in builtin:
+            iptables -t ${t.name} -N ${c.name}
+            %   end
+            %   if c.policy != 'ACCEPT':
+            iptables -t ${t.name} -P ${c.name} ${c.policy}
+            %   end
+            % end
+            % for c in t.chains:
+            %   for r in c:
+            iptables -t ${t.name} -A ${c.name} ${r}
+            %   end
+            % end
+            ''', 'iptables commands table')
+
+        def optimize(self):
+            return sum(c.optimize() for c in self.chains)
+
+        def remove(self, name):
+            self.chains.remove(self.chain_index.pop(name))
+
+        def references(self, name):
+            return sum(1 for c in self.chains for r in c
+                       if IPTables.Spec(r).jumps() == name)
+
+        def expand(self, chain):
+            """
+            The rules of chain with unconditional jumps to RETURN-free
+            chains replaced by their rules, and the chains inlined.
+            """
+            builtin = IPTables.BUILTIN_CHAINS.get(self.name, [])
+            rules = []
+            inlined = set()
+            for r in chain:
+                spec = IPTables.Spec(r)
+                name = spec.jumps()
+                sub = self.chain_index.get(name)
+                if spec.tokens != ['-j', name] or name in builtin or \
+                   name == chain.name or sub is None or \
+                   any(IPTables.Spec(x).target == 'RETURN' for x in sub):
+                    rules.append(r)
+                    continue
+                rules += sub.rules
+                inlined.add(name)
+            return rules, inlined
+
+        def dispatch(self, chain):
+            """
+            Move rules of chain limited to a single input device into a
+            chain per device, jumped to right after the leading device
+            independent rules. Chains jumped to unconditionally are inlined
+            first. A rule is only moved if it commutes with every rule it
+            is moved ahead of. Returns the number of chains created, the
+            chain is left untouched if nothing is moved.
+            """
+            rules, inlined = self.expand(chain)
+            specs = [IPTables.Spec(r) for r in rules]
+            start = 0
+            while start < len(specs) and specs[start].device() is None:
+                start += 1
+            rest = []
+            moved = {}
+            for i in range(start, len(specs)):
+                spec = specs[i]
+                device = spec.device()
+                # RETURN would continue in chain instead of ending it
+                if device is not None and spec.jumps() != 'RETURN' and \
+                   all(r.device() not in [None, device] or r.commutes(spec)
+                       for r in rest):
+                    moved.setdefault(device, []).append(i)
+                else:
+                    rest.append(spec)
+            # a dispatch chain pays off only for more than one rule
+            moved = dict((d, m) for d, m in moved.items() if len(m) > 1)
+            if not moved:
+                return 0
+            indices = set(i for m in moved.values() for i in m)
+            for e in list(chain.entries()):
+                chain.unlink(e)
+            for i, r in enumerate(rules):
+                if i == start:
+                    for device in moved.keys():
+                        chain.append('-i %s -j IF-%s-%s' %
+                                     (device, device, chain.name))
+                if i not in indices:
+                    chain.append(r)
+            for device, group in moved.items():
+                sub = self.chain('IF-%s-%s' % (device, chain.name))
+                for i in group:
+                    sub.append(specs[i].without_device())
+            for name in sorted(inlined):
+                if not self.references(name):
+                    self.remove(name)
+            return len(moved)
+
         def write_restore(self, f):
-            f.write('# %s configuration generated by %s' %
-                    (self.name, __file__))
-            f.write('*%s' % self.name)
-            for c in self.chains:
-                f.write(':%s %s [0:0]' % (c.name, c.policy))
+            IPTables.Table.RESTORE.render(f, self,
+                                          IPTables.BUILTIN_CHAINS[self.name],
+                                          __file__)
+
+        def delta(self, previous):
+            """Restore lines turning the previous table into this one."""
+            builtin = IPTables.BUILTIN_CHAINS[self.name]
+            head = []
+            edits = []
+            tail = []
             for c in self.chains:
-                for r in c.rules:
-                    f.write('%s' % r)
+                if c.name not in previous and c.name not in builtin:
+                    head.append(':%s - [0:0]' % c.name)
+                policy, rules = previous.get(c.name, ('ACCEPT', []))
+                if c.name in builtin and policy != c.policy:
+                    head.append(':%s %s [0:0]' % (c.name, c.policy))
+                edits += IPTables.Table.chain_delta(c.name, rules, c.rules)
+            removed = [name for name in previous
+                       if name not in self.chain_index and name not in builtin]
+            tail += ['-F %s' % name for name in removed]
+            tail += ['-X %s' % name for name in removed]
+            if not head and not edits and not tail:
+                return []
+            return ['*%s' % self.name] + head + edits + tail + ['COMMIT']
+
+        @staticmethod
+        def chain_delta(name, old, new):
+            # edit old into new left to right, so the edit position in the
+            # chain is always the position in new
+            lines = []
+            matcher = difflib.SequenceMatcher(None, old, new, autojunk = False)
+            for op, i1, i2, j1, j2 in matcher.get_opcodes():
+                if op == 'equal':
+                    continue
+                common = min(i2 - i1, j2 - j1) if op == 'replace' else 0
+                for k in range(common):
+                    lines.append('-R %s %d %s' % (name, j1 + k + 1,
+                                                  new[j1 + k]))
+                for k in range(i2 - i1 - common):
+                    lines.append('-D %s %d' % (name, j1 + common + 1))
+                for j in range(j1 + common, j2):
+                    lines.append('-I %s %d %s' % (name, j + 1, new[j]))
+            return lines
 
         def write_commands(self, f):
-            f.write('# %s commands generated by %s' %
-                    (self.name, __file__))
-            for c in self.chains:
-                if c.name not in IPTables.BUILTIN_CHAINS[self.name]:
-                    f.write('iptables -t %s -N %s' % (self.name, c.name))
-                if c.policy != 'ACCEPT':
-                    f.write('iptables -t %s -P %s %s' %
-                            (self.name, c.name, c.policy))
-            for c in self.chains:
-                for r in c.rules:
-                    f.write('iptables -t %s -A %s %s' % (self.name, c.name, r))
+            IPTables.Table.COMMANDS.render(f, self,
+                                           IPTables.BUILTIN_CHAINS[self.name],
+                                           __file__)
+
+    class Spec:
+        """
+        A rule split into its options. Rules using only the simple
+        options below can be compared: a rule covers another one if
+        every packet matching the other one also matches it.
+        """
+        OPTIONS = ['-i', '-o', '-p', '-s', '-d', '--sport', '--dport']
+        ADDRESSES = ['-s', '-d']
+        TERMINAL = ['ACCEPT', 'DROP', 'REJECT', 'RETURN',
+                    'MASQUERADE', 'SNAT', 'DNAT']
+
+        def __init__(self, rule):
+            self.rule = rule
+            self.tokens = rule.split()
+            self.options = {}
+            self.target = None
+            self.simple = True
+            if '-j' in self.tokens:
+                idx = self.tokens.index('-j')
+                self.target = ' '.join(self.tokens[idx + 1:])
+            else:
+                idx = len(self.tokens)
+                self.simple = False
+            for i in range(0, idx, 2):
+                opt = self.tokens[i]
+                if opt not in IPTables.Spec.OPTIONS or i + 1 >= idx or \
+                   opt in self.options:
+                    self.simple = False
+                    break
+                val = self.tokens[i + 1]
+                if opt in IPTables.Spec.ADDRESSES:
+                    try:
+                        val = ipaddress.ip_network(val, strict = False)
+                    except ValueError:
+                        self.simple = False
+                        break
+                self.options[opt] = val
+
+        def terminal(self):
+            return self.target is not None and \
+                self.target.split()[0] in IPTables.Spec.TERMINAL
+
+        def jumps(self):
+            return self.target.split()[0] if self.target else None
+
+        def device_index(self):
+            for i, t in enumerate(self.tokens[:-1]):
+                if t == '-j':
+                    break
+                if t == '-i' and (i == 0 or self.tokens[i - 1] != '!'):
+                    return i
+            return None
+
+        def device(self):
+            # the single input device the rule is limited to, if any
+            i = self.device_index()
+            if i is None or self.tokens[i + 1].endswith('+'):
+                return None
+            return self.tokens[i + 1]
+
+        def without_device(self):
+            i = self.device_index()
+            return ' '.join(self.tokens[:i] + self.tokens[i + 2:])
+
+        def ports(self, val):
+            lo, _, hi = val.partition(':')
+            return int(lo or 0), int(hi or 65535) if _ else int(lo)
+
+        def disjoint(self, other):
+            # whether no packet can match both rules
+            if not self.simple or not other.simple:
+                return False
+            for opt, val in self.options.items():
+                o = other.options.get(opt)
+                if o is None:
+                    continue
+                if opt in IPTables.Spec.ADDRESSES:
+                    if o.version != val.version or not o.overlaps(val):
+                        return True
+                elif opt in ['--sport', '--dport']:
+                    try:
+                        a, b = self.ports(val), self.ports(o)
+                    except ValueError:
+                        continue
+                    if a[1] < b[0] or b[1] < a[0]:
+                        return True
+                elif val.endswith('+') or o.endswith('+'):
+                    if not val.rstrip('+').startswith(o.rstrip('+')) and \
+                       not o.rstrip('+').startswith(val.rstrip('+')):
+                        return True
+                elif o != val:
+                    return True
+            return False
+
+        def commutes(self, other):
+            # whether the two rules can be swapped without any effect
+            return self.disjoint(other) or \
+                (self.terminal() and self.target == other.target)
+
+        def covers(self, other):
+            if not self.simple or not other.simple:
+                return False
+            for opt, val in self.options.items():
+                o = other.options.get(opt)
+                if o is None:
+                    return False
+                if opt in IPTables.Spec.ADDRESSES:
+                    if o.version != val.version or not o.subnet_of(val):
+                        return False
+                elif o != val:
+                    return False
+            return True
+
+        def key(self, opt):
+            # what must be equal for rules to be merged on opt
+            other = sorted((k, str(v)) for k, v in self.options.items()
+                           if k != opt)
+            return (self.target, self.options[opt].version, tuple(other))
+
+        def replace(self, opt, net):
+            tokens = list(self.tokens)
+            idx = tokens.index(opt)
+            if net.prefixlen == net.max_prefixlen:
+                tokens[idx + 1] = str(net.network_address)
+            else:
+                tokens[idx + 1] = str(net)
+            return ' '.join(tokens)
 
-    class Marker:
+    class Entry:
+        """A rule in a chain, linked to its neighbours."""
+        def __init__(self, rule):
+            self.rule = rule
+            self.prev = self.next = None
+
+    class Marker(Entry):
+        """A named position in a chain, a stable handle for insertion."""
         def __init__(self, name):
+            IPTables.Entry.__init__(self, None)
             self.name = name
 
     class Chain:
+        """
+        A chain of rules kept as a doubly linked list between two sentinel
+        markers. Named markers are indexed, so rules can be added next to
+        them without searching the chain.
+        """
         def __init__(self, name, policy = None):
             self.name = name
             self.policy = policy if policy is not None else 'ACCEPT'
-            self.rules = []
+            self.head = IPTables.Marker(None)
+            self.tail = IPTables.Marker(None)
+            self.head.next = self.tail
+            self.tail.prev = self.head
+            self.markers = {}
+            self.count = 0
+
+        def __iter__(self):
+            e = self.head.next
+            while e is not self.tail:
+                if e.rule is not None:
+                    yield e.rule
+                e = e.next
+
+        def __len__(self):
+            return self.count
+
+        @property
+        def rules(self):
+            return list(self)
+
+        def link(self, entry, before):
+            entry.prev = before.prev
+            entry.next = before
+            before.prev.next = entry
+            before.prev = entry
+            if entry.rule is not None:
+                self.count += 1
+            return entry
+
+        def unlink(self, entry):
+            entry.prev.next = entry.next
+            entry.next.prev = entry.prev
+            entry.prev = entry.next = None
+            if entry.rule is not None:
+                self.count -= 1
+
+        def lookup(self, name):
+            if name not in self.markers:
+                raise RuntimeError('chain %s has no marker %s' %
+                                   (self.name, name))
+            return self.markers[name]
+
+        def position(self, index):
+            # the entry currently at rule index, or the tail
+            e = self.head.next
+            while e is not self.tail:
+                if e.rule is not None:
+                    if index == 0:
+                        break
+                    index -= 1
+                e = e.next
+            return e
 
         def marker(self, name, index = -1):
-            if index > -1:
-                self.rules.insert(index, Marker(name))
-            else:
-                self.rules.append(Marker(name))
-
-        def marker_index(self, name):
-            for idx in range(0, len(self.rules)):
-                if type(self.rules[idx]) == Marker:
-                    return idx
-            return -1
+            if name in self.markers:
+                raise RuntimeError('chain %s already has marker %s' %
+                                   (self.name, name))
+            before = self.position(index) if index > -1 else self.tail
+            m = self.markers[name] = self.link(IPTables.Marker(name), before)
+            return m
 
         def insert(self, rule, after_mark = None, before_mark = None, index = 0):
             if after_mark and before_mark:
                 raise RuntimeError('both before and after marker given')
             if after_mark:
-                idx = self.marker_index(after_mark)
-                idx += 1 + index
+                before = self.lookup(after_mark).next
+                for i in range(0, index):
+                    if before is self.tail:
+                        break
+                    before = before.next
             elif before_mark:
-                idx = self.marker_index(before_mark)
-                idx -= index
-            self.rules(insert, idx, rule)
+                before = self.lookup(before_mark)
+                for i in range(0, index):
+                    if before.prev is self.head:
+                        break
+                    before = before.prev
+            else:
+                before = self.position(index)
+            return self.link(IPTables.Entry(rule), before)
 
         def append(self, rule, before_mark = None):
             if before_mark:
-                idx = self.marker_index(before_mark)
+                before = self.lookup(before_mark)
             else:
-                idx = len(self.rules)
-            self.rules.insert(idx, rule)
-
-    def __init__(self, policy = None):
+                before = self.tail
+            return self.link(IPTables.Entry(rule), before)
+
+        def entries(self):
+            e = self.head.next
+            while e is not self.tail:
+                if e.rule is not None:
+                    yield e
+                e = e.next
+
+        def optimize(self):
+            """Remove redundant rules, return the number of rules removed."""
+            count = len(self)
+            self.remove_shadowed()
+            for opt in IPTables.Spec.ADDRESSES:
+                self.collapse(opt)
+            return count - len(self)
+
+        def remove_shadowed(self):
+            # a packet never gets past an earlier matching terminal rule
+            seen = set()
+            earlier = {}
+            for e in list(self.entries()):
+                spec = IPTables.Spec(e.rule)
+                if not spec.terminal():
+                    continue
+                if e.rule in seen:
+                    self.unlink(e)
+                    continue
+                covering = earlier.setdefault(spec.target, [])
+                if any(x.covers(spec) for x in covering):
+                    self.unlink(e)
+                    continue
+                seen.add(e.rule)
+                if spec.simple:
+                    covering.append(spec)
+
+        def collapse(self, opt):
+            # consecutive terminal rules with the same target can be
+            # reordered freely, merge their addresses within such runs
+            run = []
+            for e in list(self.entries()) + [None]:
+                spec = IPTables.Spec(e.rule) if e is not None else None
+                if run and (spec is None or not spec.terminal() or
+                            spec.target != run[0][1].target):
+                    self.collapse_run(run, opt)
+                    run = []
+                if spec is not None and spec.terminal():
+                    run.append((e, spec))
+
+        def collapse_run(self, run, opt):
+            groups = {}
+            for e, spec in run:
+                if spec.simple and opt in spec.options:
+                    groups.setdefault(spec.key(opt), []).append((e, spec))
+            for group in groups.values():
+                nets = list(ipaddress.collapse_addresses(
+                    [spec.options[opt] for e, spec in group]))
+                if len(nets) >= len(group):
+                    continue
+                first = group[0][0]
+                for net in nets:
+                    self.link(IPTables.Entry(group[0][1].replace(opt, net)),
+                              first)
+                for e, spec in group:
+                    self.unlink(e)
+
+    def __init__(self, fs, policy = None):
+        self.fs = fs
         self.filter = IPTables.Table('filter',
                                      [('INPUT', policy or 'DROP'),
                                       ('FORWARD', policy or 'DROP'),
@@ -126,30 +560,384 @@ class IPTables:
             'mangle': self.mangle,
             'raw': self.raw
         }
+        self.sets = {}
 
-    def set_policy(self, chain, policy):
-        c = self.chains[self.chain_index[chain]]
-        c.policy = policy
+    def set_policy(self, chain, policy, table = 'filter'):
+        self.chain(table, chain).policy = policy
 
     def table(self, name):
         return self.tables[name]
 
+    def optimize(self):
+        return sum(t.optimize() for t in self.tables.values())
+
+    def dispatch(self):
+        """Split INPUT and FORWARD into per input device chains."""
+        count = 0
+        for name in ['INPUT', 'FORWARD']:
+            count += self.filter.dispatch(self.chain('filter', name))
+        return count
+
+    def ipset(self, name, networks):
+        """Create an ipset of networks of one family, return its name."""
+        nets = list(ipaddress.collapse_addresses(networks))
+        family = 'inet' if nets[0].version == 4 else 'inet6'
+        entries = [str(n.network_address) if n.prefixlen == n.max_prefixlen
+                   else str(n) for n in nets]
+        self.sets[name] = IPTables.IPSet(name, family, entries)
+        return name
+
     def chain(self, table, name):
         return self.table(table).chain(name)
 
+    @staticmethod
+    def parse(text):
+        """
+        Parse a ruleset in either syntax written by write into a dict of
+        tables, each a dict of chain names to their policy and rules.
+        """
+        tables = {}
+        table = None
+        for line in text.splitlines():
+            tokens = line.split()
+            if not tokens or tokens[0].startswith('#'):
+                continue
+            if tokens[0] == 'iptables' and len(tokens) > 4 and \
+               tokens[1] == '-t':
+                table = tables.setdefault(tokens[2], {})
+                op, name, args = tokens[3], tokens[4], tokens[5:]
+            elif tokens[0].startswith('*'):
+                table = tables.setdefault(tokens[0][1:], {})
+                continue
+            elif tokens[0].startswith(':') and table is not None:
+                op, name, args = '-P', tokens[0][1:], tokens[1:2]
+            elif tokens[0] == '-A' and table is not None and len(tokens) > 1:
+                op, name, args = tokens[0], tokens[1], tokens[2:]
+            else:
+                continue
+            chain = table.setdefault(name, ['ACCEPT', []])
+            if op == '-P' and args and args[0] != '-':
+                chain[0] = args[0]
+            elif op == '-A':
+                chain[1].append(' '.join(args))
+        return tables
+
+    DELTA = Template('lines, path, generator', '''
+        # iptables-restore --noflush delta generated by ${generator}
+        # turns the ruleset generated before the last change into ${path}
+        % for l in lines:
+        ${l}
+        % end
+        ''', 'iptables-restore delta')
+
+    def write_delta(self, fs, previous, syntax = 'iptables'):
+        """
+        Write the minimal per-chain edits from the previous ruleset. If
+        the ruleset did not change the delta of the last change is kept,
+        so an unchanged configuration leaves the delta untouched too.
+        """
+        lines = []
+        for t in self.tables.values():
+            lines += t.delta(previous.get(t.name, {}))
+        path = IPTables.CONFIG_FILES['delta']
+        if not lines:
+            last = fs.previous(path)
+            if last is not None:
+                f = fs.open(path)
+                f.write(last, end = '')
+                f.close()
+            return
+        f = fs.open(path)
+        IPTables.DELTA.render(f, lines, IPTables.CONFIG_FILES[syntax],
+                              __file__)
+        f.close()
+
     def write(self, fs, syntax = 'iptables', paths = None):
         if not paths:
             paths = IPTables.CONFIG_FILES
+        if self.sets:
+            s = fs.open(IPTables.CONFIG_FILES['ipset'])
+            for name in sorted(self.sets.keys()):
+                self.sets[name].write_restore(s)
+            s.close()
         f = fs.open(IPTables.CONFIG_FILES[syntax])
+        if syntax == 'iptables' and self.sets:
+            f.write('ipset -exist restore -file %s' %
+                    IPTables.CONFIG_FILES['ipset'])
         if syntax == 'restore':
             for t in self.tables.values():
                 t.write_restore(f)
-            f.write('COMMIT')
         else:
             for t in self.tables.values():
                 t.write_commands(f)
         f.close()
 
+class NFTables:
+    """
+    Compiles a collected IPTables ruleset into a single nft -f script,
+    loaded in one transaction. The filter, mangle and raw tables go into
+    one inet table, nat into an ip table. Runs of rules matching only
+    on interface pairs become iifname . oifname verdict maps, runs of
+    rules matching only on addresses become sets, and ipsets become
+    named sets.
+    """
+
+    TABLES = [('inet', 'filter', ['raw', 'mangle', 'filter']),
+              ('ip'  , 'nat'   , ['nat'])]
+
+    HOOKS = {
+        'filter': ('filter',    0),
+        'mangle': ('filter', -150),
+        'raw':    ('filter', -300),
+    }
+    NAT_HOOKS = {
+        'PREROUTING':  -100,
+        'INPUT':        100,
+        'OUTPUT':      -100,
+        'POSTROUTING':  100,
+    }
+    VERDICTS = {
+        'ACCEPT': 'accept', 'DROP': 'drop', 'REJECT': 'reject',
+        'RETURN': 'return', 'MASQUERADE': 'masquerade',
+    }
+    MAP_VERDICTS = ['ACCEPT', 'DROP', 'RETURN']
+
+    class Table:
+        def __init__(self, family, name):
+            self.family = family
+            self.name = name
+            self.sets = []
+            self.chains = []
+
+    class Chain:
+        def __init__(self, name, type = None, hook = None, priority = 0,
+                     policy = 'ACCEPT'):
+            self.name = name
+            self.type = type
+            self.hook = hook
+            self.priority = priority
+            self.policy = policy.lower()
+            self.rules = []
+
+    class Set:
+        def __init__(self, ipset):
+            self.name = ipset.name
+            self.type = 'ipv4_addr' if ipset.family == 'inet' else 'ipv6_addr'
+            self.interval = any('/' in e for e in ipset.entries)
+            self.entries = ipset.entries
+
+    SCRIPT = Template('tables, generator', '''
+        #!/usr/sbin/nft -f
+        # nftables configuration generated by ${generator}
+        % for t in tables:
+        table ${t.family} ${t.name}
+        delete table ${t.family} ${t.name}
+        table ${t.family} ${t.name} {
+        %   for s in t.sets:
+            set ${s.name} {
+                type ${s.type}
+        %     if s.interval:
+                flags interval
+        %     end
+                elements = { ${', '.join(s.entries)} }
+            }
+        %   end
+        %   for c in t.chains:
+            chain ${c.name} {
+        %     if c.hook:
+                type ${c.type} hook ${c.hook} priority ${c.priority}; policy ${c.policy};
+        %     end
+        %     for r in c.rules:
+                ${r}
+        %     end
+            }
+        %   end
+        }
+        % end
+        ''', 'nftables script')
+
+    def __init__(self, ipt):
+        self.ipt = ipt
+        self.tables = []
+        for family, name, sources in NFTables.TABLES:
+            t = NFTables.Table(family, name)
+            for source in sources:
+                self.compile_table(t, source)
+            if t.chains:
+                self.tables.append(t)
+
+    def chain_name(self, table, name):
+        if table in ['filter', 'nat']:
+            return name
+        return '%s-%s' % (table, name)
+
+    def compile_table(self, t, table):
+        builtin = IPTables.BUILTIN_CHAINS[table]
+        for c in self.ipt.table(table).chains:
+            if c.name in builtin:
+                if table != 'filter' and not len(c):
+                    continue
+                if table == 'nat':
+                    chain = NFTables.Chain(c.name, 'nat', c.name.lower(),
+                                           NFTables.NAT_HOOKS[c.name],
+                                           c.policy)
+                else:
+                    type, priority = NFTables.HOOKS[table]
+                    chain = NFTables.Chain(self.chain_name(table, c.name),
+                                           type, c.name.lower(), priority,
+                                           c.policy)
+            else:
+                chain = NFTables.Chain(self.chain_name(table, c.name))
+            chain.rules = self.compile_chain(table, c)
+            t.chains.append(chain)
+        if t.family == 'inet' and table == 'filter':
+            for name in sorted(self.ipt.sets.keys()):
+                t.sets.append(NFTables.Set(self.ipt.sets[name]))
+
+    def compile_chain(self, table, chain):
+        rules = []
+        run = []
+        for rule in list(chain) + [None]:
+            spec = IPTables.Spec(rule) if rule is not None else None
+            kind = self.mergeable(spec)
+            if run and (kind is None or kind != run[0][0] or
+                        spec.target != run[0][1].target and kind == 'addr'):
+                rules += self.compile_run(table, run)
+                run = []
+            if kind is not None:
+                run.append((kind, spec))
+            elif rule is not None:
+                rules.append(self.translate(table, rule))
+        return rules
+
+    def mergeable(self, spec):
+        # rules that can be looked up from a verdict map or a set
+        if spec is None or not spec.simple:
+            return None
+        opts = sorted(spec.options.keys())
+        if opts == ['-i', '-o'] and spec.target in NFTables.MAP_VERDICTS and \
+           not spec.options['-i'].endswith('+') and \
+           not spec.options['-o'].endswith('+'):
+            return 'ifpair'
+        if opts == ['-s'] and spec.terminal():
+            return 'addr'
+        return None
+
+    def compile_run(self, table, run):
+        if len(run) < 2:
+            return [self.translate(table, run[0][1].rule)]
+        if run[0][0] == 'ifpair':
+            entries = ['"%s" . "%s" : %s' %
+                       (s.options['-i'], s.options['-o'],
+                        NFTables.VERDICTS[s.target]) for k, s in run]
+            return ['iifname . oifname vmap { %s }' % ', '.join(entries)]
+        rules = []
+        for version in [4, 6]:
+            nets = [str(s.options['-s']) for k, s in run
+                    if s.options['-s'].version == version]
+            if nets:
+                rules.append('%s saddr { %s } %s' %
+                             ('ip' if version == 4 else 'ip6',
+                              ', '.join(nets),
+                              self.verdict(table, run[0][1].target.split())))
+        return rules
+
+    def ifname(self, name):
+        return '"%s*"' % name[:-1] if name.endswith('+') else '"%s"' % name
+
+    def verdict(self, table, args):
+        target = args[0]
+        if target in NFTables.VERDICTS and len(args) == 1:
+            return NFTables.VERDICTS[target]
+        if target == 'SNAT' and len(args) == 3 and args[1] == '--to':
+            return 'snat to %s' % args[2]
+        if target == 'DNAT' and len(args) == 3 and \
+           args[1] == '--to-destination':
+            return 'dnat to %s' % args[2]
+        if target == 'MARK' and len(args) == 3 and args[1] == '--set-mark':
+            value, mask = self.mark(args[2])
+            return 'meta mark set meta mark and 0x%x or 0x%x' % \
+                (~mask & 0xffffffff, value)
+        if len(args) == 1 and target in self.ipt.table(table).chain_index:
+            return 'jump %s' % self.chain_name(table, target)
+        return None
+
+    def mark(self, arg):
+        value, _, mask = arg.partition('/')
+        return int(value, 0), int(mask or '0xffffffff', 0)
+
+    def translate(self, table, rule):
+        tokens = rule.split()
+        match = []
+        proto = None
+        ports = []
+        verdict = None
+        i = 0
+        while i < len(tokens):
+            t = tokens[i]
+            args = tokens[i + 1:]
+            if t == '!' and args[0:1] in [['-i'], ['-o']] and len(args) > 1:
+                match.append('%s != %s' % ('iifname' if args[0] == '-i' else
+                                           'oifname', self.ifname(args[1])))
+                i += 3
+            elif t in ['-i', '-o'] and args:
+                match.append('%s %s' % ('iifname' if t == '-i' else 'oifname',
+                                        self.ifname(args[0])))
+                i += 2
+            elif t in ['-m', '--match'] and len(args) >= 3 and \
+                 args[0:2] == ['mark', '--mark']:
+                value, mask = self.mark(args[2])
+                match.append('meta mark and 0x%x == 0x%x' % (mask, value))
+                i += 4
+            elif t in ['-s', '-d'] and args:
+                net = ipaddress.ip_network(args[0], strict = False)
+                match.append('%s %s %s' % ('ip' if net.version == 4 else 'ip6',
+                                           'saddr' if t == '-s' else 'daddr',
+                                           args[0]))
+                i += 2
+            elif t == '-p' and args:
+                proto = args[0]
+                i += 2
+            elif t in ['--sport', '--dport'] and args:
+                ports.append('%s %s' % (t[2:], args[0].replace(':', '-')))
+                i += 2
+            elif t in ['-m', '--match'] and args[0:2] == ['set', '--match-set'] \
+                 and len(args) >= 4 and args[2] in self.ipt.sets:
+                s = self.ipt.sets[args[2]]
+                match.append('%s %s @%s' % ('ip' if s.family == 'inet' else 'ip6',
+                                            'saddr' if args[3] == 'src' else
+                                            'daddr', s.name))
+                i += 5
+            elif t in ['-m', '--match'] and len(args) >= 3 and \
+                 args[0] == 'conntrack' and args[1] in ['--cstate', '--ctstate']:
+                states = args[2].lower().split(',')
+                if len(states) > 1:
+                    match.append('ct state { %s }' % ', '.join(states))
+                else:
+                    match.append('ct state %s' % states[0])
+                i += 4
+            elif t == '-j' and args:
+                verdict = self.verdict(table, args)
+                break
+            else:
+                break
+        if verdict is None:
+            raise RuntimeError('cannot translate iptables rule "%s" to ' \
+                               'nftables' % rule)
+        if ports:
+            if not proto:
+                raise RuntimeError('port match without protocol in rule "%s"' %
+                                   rule)
+            match += ['%s %s' % (proto, p) for p in ports]
+        elif proto:
+            match.append('meta l4proto %s' % proto)
+        return ' '.join(match + [verdict])
+
+    def write(self, fs):
+        f = fs.open(IPTables.CONFIG_FILES['nftables'], mode = 0o755)
+        NFTables.SCRIPT.render(f, self.tables, __file__)
+        f.close()
+
 class Firewall(Node):
     def __init__(self, nodedef, root, parent, node_tkn):
         Node.__init__(self, nodedef, root, parent, node_tkn)
@@ -160,6 +948,8 @@ class Firewall(Node):
         self.trusted_networks = []
         self.trusted_hosts = []
         self.snats = []
+        self.ipset_threshold = None
+        self.backend = None
 
     def parse_protect(self, kw_protect, *tokens):
         self.process_list(tokens, self.collect_device, self.protected)
@@ -191,6 +981,15 @@ class Firewall(Node):
     def parse_accept(self, kw_accept, *tokens):
         pass
 
+    def parse_ipset(self, kw_ipset, token):
+        self.ipset_threshold = int(token.str)
+
+    def parse_backend(self, kw_backend, token):
+        if token.str not in ['iptables', 'nftables']:
+            raise RuntimeError('%s:%d: unknown firewall backend %s' %
+                               (self.where(token) + (token.str,)))
+        self.backend = token.str
+
     def parse_snat(self, kw_snat, *tokens):
         self.process_list(tokens, self.collect_snat, self.snats)
 
@@ -207,20 +1006,40 @@ def allow_conntrack(ipt):
     c = ipt.chain('filter', 'FORWARD')
     c.append('-m conntrack --cstate RELATED,ESTABLISHED -j ACCEPT')
 
+def ipset_threshold():
+    threshold = IPTables.IPSET_THRESHOLD
+    for fw in Parser.nodes['firewall'].nodes:
+        if fw.ipset_threshold is not None:
+            threshold = min(threshold, fw.ipset_threshold)
+    return threshold
+
 def allow_trusted(ipt):
-    c = chain = None
+    rules = []
+    networks = []
     for fw in Parser.nodes['firewall'].nodes:
-        if fw.trusted_interfaces or fw.trusted_networks or fw.trusted_hosts:
-            if not c:
-                chain = 'CHECK-TRUSTED'
-                c = ipt.chain('filter', chain)
-            for i in fw.trusted_interfaces:
-                c.append('-i %s -j ACCEPT' % i)
+        for i in fw.trusted_interfaces:
+            rules.append('-i %s -j ACCEPT' % i)
+        networks += [n.network for n in fw.trusted_networks]
+        networks += [ipaddress.ip_network(h) for h in fw.trusted_hosts]
+    if len(networks) > ipset_threshold():
+        # match long lists with a single rule per address family
+        for version, name in [(4, 'trusted-inet'), (6, 'trusted-inet6')]:
+            nets = [n for n in networks if n.version == version]
+            if nets:
+                rules.append('-m set --match-set %s src -j ACCEPT' %
+                             ipt.ipset(name, nets))
+    else:
+        for fw in Parser.nodes['firewall'].nodes:
             for n in fw.trusted_networks:
-                c.append('-s %s -j ACCEPT' % n.with_prefixlen)
+                rules.append('-s %s -j ACCEPT' % n.with_prefixlen)
             for h in fw.trusted_hosts:
-                c.append('-s %s -j ACCEPT' % str(h))
-    if chain:
+                rules.append('-s %s -j ACCEPT' % str(h))
+    if rules:
+        chain = 'CHECK-TRUSTED'
+        c = ipt.chain('filter', chain)
+        # all rules accept, so their order does not matter
+        for r in ipt.fs.ordered(rules):
+            c.append(r)
         ipt.chain('filter', 'FORWARD').append('-j %s' % chain)
         ipt.chain('filter', 'INPUT').append('-j %s' % chain)
 
@@ -229,38 +1048,84 @@ def allow_services(ipt):
     # accept any explicitly enabled services
     pass
 
-def isolate_interfaces(ipt):
-    c = chain = None
+def isolate_zones():
+    """
+    Split isolate groups into zones and groups isolated pairwise. A
+    zone is a group of plain devices not sharing a device with another
+    group, so each device can be marked with its single zone.
+    """
+    groups = []
     for fw in Parser.nodes['firewall'].nodes:
         for devices in fw.isolated:
-            if not c:
-                chain = 'CHECK-ISOLATE'
-                c = ipt.chain('filter', chain)
-            if len(devices) == 1:
-                c.append('-i %s -o %s -j DROP' % (devices[0], devices[0]))
-            else:
-                for src in devices:
-                    for dst in devices:
-                        if src != dst:
-                            c.append('-i %s -o %s -j DROP' % (src, dst))
-    if chain:
+            groups.append(list(dict.fromkeys(devices)))
+    count = {}
+    for devices in groups:
+        for d in devices:
+            count[d] = count.get(d, 0) + 1
+    zones = []
+    pairs = []
+    for devices in groups:
+        if len(devices) > 1 and \
+           not any(d.endswith('+') or count[d] > 1 for d in devices):
+            zones.append(devices)
+        else:
+            pairs.append(devices)
+    limit = IPTables.ZONE_MASK >> IPTables.ZONE_SHIFT
+    if len(zones) > limit:
+        pairs += zones[limit:]
+        zones = zones[:limit]
+    return zones, pairs
+
+def isolate_interfaces(ipt):
+    rules = []
+    marks = []
+    zones, pairs = isolate_zones()
+    for devices in pairs:
+        if len(devices) == 1:
+            rules.append('-i %s -o %s -j DROP' % (devices[0], devices[0]))
+        else:
+            for src in devices:
+                for dst in devices:
+                    if src != dst:
+                        rules.append('-i %s -o %s -j DROP' % (src, dst))
+    # mark packets with the zone of their input device once, then drop
+    # them if they would leave through another device of the same zone
+    for idx, devices in enumerate(zones, 1):
+        mark = '0x%x/0x%x' % (idx << IPTables.ZONE_SHIFT, IPTables.ZONE_MASK)
+        for d in devices:
+            marks.append('-i %s -j MARK --set-mark %s' % (d, mark))
+            rules.append('! -i %s -o %s -m mark --mark %s -j DROP' %
+                         (d, d, mark))
+    if marks:
+        c = ipt.chain('mangle', 'PREROUTING')
+        for r in ipt.fs.ordered(marks):
+            c.append(r)
+    if rules:
+        chain = 'CHECK-ISOLATE'
+        c = ipt.chain('filter', chain)
+        # all rules drop, so their order does not matter
+        for r in ipt.fs.ordered(rules):
+            c.append(r)
         ipt.chain('filter', 'FORWARD').append('-j %s' % chain)
 
 def nat_source(ipt):
     c = chain = None
-    uplinks = snats = []
+    uplinks = []
+    snats = []
     for i in Parser.nodes['interface'].nodes:
         if i.uplink:
             uplinks.append(i.name)
     for fw in Parser.nodes['firewall'].nodes:
         snats += fw.snats
 
-    snats = list(set(uplinks + snats))
+    snats = set(uplinks + snats)
 
     if snats:
         chain = 'SOURCE-NAT'
         c = ipt.chain('nat', chain)
-        for i in Parser.nodes['interface'].nodes:
+        interfaces = ipt.fs.ordered(Parser.nodes['interface'].nodes,
+                                    key = lambda x: x.name)
+        for i in interfaces:
             if i.name in snats:
                 if i.addresses == 'dhcp':
                     c.append('-o %s -j MASQUERADE' % i.name)
@@ -299,8 +1164,18 @@ def custom_rules(ipt):
                 continue
             ipt.chain('filter', c.chain).append(c.generate())
 
+def firewall_backend():
+    backend = None
+    for fw in Parser.nodes['firewall'].nodes:
+        if fw.backend is not None:
+            if backend is not None and backend != fw.backend:
+                raise RuntimeError('%s:%d: conflicting firewall backends' %
+                                   fw.where())
+            backend = fw.backend
+    return backend or 'iptables'
+
 def generate_firewall(nodedef, nodes, fs):
-    ipt = IPTables()
+    ipt = IPTables(fs)
 
     allow_conntrack(ipt)
     allow_trusted(ipt)
@@ -310,8 +1185,22 @@ def generate_firewall(nodedef, nodes, fs):
     nat_destination(ipt)
     custom_rules(ipt)
 
+    removed = ipt.optimize()
+    if removed:
+        log.progress('firewall optimizer removed %d redundant rules' % removed)
+    dispatched = ipt.dispatch()
+    if dispatched:
+        log.progress('firewall dispatches to %d per-device chains' % dispatched)
+
     # write out ruleset
-    ipt.write(fs)
+    if firewall_backend() == 'nftables':
+        NFTables(ipt).write(fs)
+    else:
+        ipt.write(fs)
+        # reload small changes without flushing the running ruleset
+        previous = fs.previous(IPTables.CONFIG_FILES['iptables'])
+        if previous is not None:
+            ipt.write_delta(fs, IPTables.parse(previous))
 
 
 class Rule(Node):
@@ -323,7 +1212,6 @@ class Rule(Node):
         self.ifin = self.ifout = None
         self.proto = None
         self.src_addr = self.src_port = self.dst_addr = self.dst_port = None
-        self.rule = ''
 
     def parse_chain(self, kw_chain):
         self.chain = kw_chain.str.strip('_').upper()
@@ -357,26 +1245,17 @@ class Rule(Node):
         else:
             self.dst_addr, self.dst_port = addr, port
 
-    def append(self, option, arg):
-        t = ' ' if self.rule else ''
-        if arg:
-            self.rule += '%s%s %s' % (t, option, arg)
-
-    def restore(self, str):
-        t = ' ' if self.restore else ''
-        self.restore += '%s%s' % (t, str)
-
-    def generate(self):
-        self.rule = ' '.join([x.generate() for x in self.children])
-        self.append('-i', self.ifin)
-        self.append('-o', self.ifout)
-        self.append('-p', self.proto)
-        self.append('-s', self.src_addr)
-        self.append('--sport', self.src_port)
-        self.append('-d', self.dst_addr)
-        self.append('--dport', self.dst_port)
-        self.append('-j',  self.action)
-        return self.rule
+    def generate(self, action = None):
+        # no state is modified, nodes are shared by concurrent generators
+        rule = [x.generate() for x in self.children]
+        for option, arg in [('-i', self.ifin), ('-o', self.ifout),
+                            ('-p', self.proto),
+                            ('-s', self.src_addr), ('--sport', self.src_port),
+                            ('-d', self.dst_addr), ('--dport', self.dst_port),
+                            ('-j', action or self.action)]:
+            if arg:
+                rule.append('%s %s' % (option, arg))
+        return ' '.join(rule)
 
 class Allow(Rule):
     def __init__(self, nodedef, root, parent, node_tkn):
@@ -401,8 +1280,7 @@ class Dnat(Rule):
         self.to = token.str
 
     def generate(self):
-        self.action = '-j DNAT --to-destination %s' % self.to
-        return Rule.generate(self)
+        return Rule.generate(self, 'DNAT --to-destination %s' % self.to)
 
 
 class Match(Node):
@@ -422,7 +1300,7 @@ NodeDef('firewall', Firewall, 0,
         Lexer.Keywords(['protect', 'accept', 'drop', 'reject',
                         'trusted', 'host', 'interface', 'net', 'network',
                         'snat', 'input', 'output', 'forward',
-                        'isolate']),
+                        'isolate', 'ipset-threshold', 'backend']),
         Lexer.NoTokens(),
         [Parser.Rule('_protect_ _token_(, _token_)*' , 'parse_protect'),
          Parser.Rule('_isolate_ _token_(, _token_)*' , 'parse_isolate'),
@@ -430,8 +1308,15 @@ NodeDef('firewall', Firewall, 0,
                      'parse_trusted'),
          Parser.Rule('_trusted_ (_interface_)'       , 'parse_trusted'),
          Parser.Rule('_snat_ _token_(, _token_)*'    , 'parse_snat'   ),
-         Parser.Rule('_accept_ _token_( _token_)*'   , 'parse_accept' )],
-        generate_firewall)
+         Parser.Rule('_accept_ _token_( _token_)*'   , 'parse_accept' ),
+         Parser.Rule('_ipset-threshold_ _int_'       , 'parse_ipset'  ),
+         Parser.Rule('_backend_ _token_'             , 'parse_backend')],
+        generate_firewall,
+        depends = ['interface'],
+        units = [('/etc/sysconfig/iptables', 'iptables.service'),
+                 ('/etc/sysconfig/iptables-commands', 'iptables.service'),
+                 ('/etc/sysconfig/ipset', 'ipset.service'),
+                 ('/etc/sysconfig/nftables.conf', 'nftables.service')])
 
 NodeDef('match', Match, 1,
         Lexer.NoKeywords(),
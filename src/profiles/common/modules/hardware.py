@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
 from genconfig.parser import *
+from genconfig.template import Template
 
 class Hardware(Node):
+    ETHERNET = Template('interfaces, setup', '''
+        INTERFACES="${','.join(interfaces)}"
+        SETUP_METHOD="${setup}"
+        ''', 'sysconfig ethernet')
+
     def __init__(self, nodedef, root, parent, node_tkn):
         Node.__init__(self, nodedef, root, parent, node_tkn)
         self.ethernet = { 'setup': None, 'devices': [] }
@@ -32,18 +38,14 @@ class Hardware(Node):
 
     def generate_ethernet(self, fs):
         log.progress('generating ethernet HW configuration...')
-        t = ''
-        interfaces = ''
+        interfaces = []
         for dev in self.ethernet['devices']:
             if type(dev) == type(()):
-                name, mac = dev
-                interfaces += '%s%s=%s' % (t, name, mac)
+                interfaces.append('%s=%s' % dev)
             else:
-                interfaces += '%s%s' % (t, dev)
-            t=','
+                interfaces.append(dev)
         f = fs.open('/etc/sysconfig/ethernet')
-        f.write('INTERFACES="%s"' % interfaces)
-        f.write('SETUP_METHOD="%s"' % self.ethernet['setup'])
+        Hardware.ETHERNET.render(f, interfaces, self.ethernet['setup'])
         f.close()
 
     def generate(self, fs):
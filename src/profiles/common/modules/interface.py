@@ -4,8 +4,26 @@ import ipaddress
 
 from genconfig.parser import *
 from genconfig.lexer import *
+from genconfig.template import Template
 
 class Interface(Node):
+    NETWORK = Template('i', '''
+        % if i.addresses == 'dhcp':
+        DHCP=ipv4
+        % elif i.addresses != 'down':
+        %   for a in i.addresses:
+        Address=${a}
+        %   end
+        % end
+        LinkLocalAddressing=no
+        % for id in i.vlans:
+        VLAN=${i.name}.${id}
+        % end
+        ''', 'network Network section')
+
+    # keys systemd-networkd accepts more than once in a section
+    REPEATED = ['Address', 'DNS', 'VLAN']
+
     def __init__(self, nodedef, root, parent, node_tkn, name):
         Node.__init__(self, nodedef, root, parent, node_tkn)
         self.name = name.str
@@ -73,22 +91,15 @@ class Interface(Node):
         log.progress('generating network interface %s...' % self.name)
         prio = 20 if '.' in self.name else 10
         path = '/etc/systemd/network/%d-%s.network' % (prio, self.name)
-        f = fs.open(path, ini=True)
+        f = fs.open(path, ini=True, duplicates='error',
+                    repeated=Interface.REPEATED)
         f.write('Name=%s' % self.name, 'Match')
-        if type(self.addresses) == type(''):
-            if self.addresses == 'dhcp':
-                f.write('DHCP=ipv4', 'Network')
-        else:
-            for a in self.addresses:
-                f.write('Address=%s' % str(a), 'Network')
-        f.write('LinkLocalAddressing=no', 'Network')
-        for id in self.vlans:
-            f.write('VLAN=%s.%d' % (self.name, id), 'Network')
+        Interface.NETWORK.render(f, self, section = 'Network')
         f.close()
         for id in self.vlans:
             log.progress('generating device for VLAN #%d...' % id)
             f = fs.open('/etc/systemd/network/00-%s-vlan%d.netdev' %
-                        (self.name, id), ini=True)
+                        (self.name, id), ini=True, duplicates='error')
             f.write('Name=%s.%d' % (self.name, id), 'NetDev')
             f.write('Kind=vlan')
             f.write('Id=%d' % id, 'VLAN')
@@ -109,4 +120,5 @@ NodeDef(
      Parser.Rule('_uplink_'                                   , 'parse_uplink'),
     ],
     generate_interfaces,
+    units = [('/etc/systemd/network/*', 'systemd-networkd.service')]
 )
@@ -9,7 +9,7 @@ class Nameserver(Node):
         self.backend = backend.str
 
 def generate_dnsmasq(ns, fs):
-    print('* should generate dnsmasq config...')
+    log.warning('dnsmasq configuration is not generated yet')
 
 def generate_bind(ns, fs):
     raise RuntimeError('support for bind is not implemented')
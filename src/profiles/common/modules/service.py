@@ -76,8 +76,8 @@ def generate_services(nodedef, nodes, fs):
     for s in Parser.nodes['service'].nodes:
         enabled += [e[0] for e in s.enable]
         disabled += [e[0] for e in s.disable]
-    enabled = list(set(enabled))
-    disabled = list(set(disabled))
+    enabled = sorted(set(enabled))
+    disabled = sorted(set(disabled))
 
     for s in enabled:
         service = SystemdService(s)
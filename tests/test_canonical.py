@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+#
+# Canonical mode must produce byte-identical output regardless of the
+# order of the top-level blocks in the configuration.
+#
+
+import os, sys, random, shutil, subprocess, tempfile, unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+GEN_CONFIG = os.path.join(os.path.dirname(TESTS_DIR), 'src', 'gen-config')
+
+ROUNDS = 10
+
+# no service block, services are generated from the host's systemd units
+MODULES = '@modules hardware, interface, dhcp-server, firewall, nameserver\n'
+BLOCKS = ['''
+hardware
+    ethernet sort-mac wan, lan
+''', '''
+interface wan
+    config dhcp
+    uplink
+''', '''
+interface lan
+    config ipv4 192.168.1.1/24, 10.0.0.1/24
+    vlans 33-35
+''', '''
+interface lan.33
+    config ipv4 192.168.33.254/24
+    dhcp-server
+        domain lan33.example
+        router last
+        nameservers router
+''', '''
+interface lan.34
+    config ipv4 192.168.34.254/24
+    dhcp-server
+        domain lan34.example
+        router last
+        nameservers router
+''', '''
+interface lan.35
+    config ipv4 192.168.35.254/24
+    firewall trusted interface
+''', '''
+firewall
+    protect lan.+
+    isolate lan.+
+    trusted network 192.168.39.0/24
+    trusted host 10.1.2.3
+    snat wan
+    dnat in lan.33 tcp dst :22 to 192.168.22.22:22
+    allow input tcp dst 22
+    deny forward udp dst 55
+''', '''
+firewall
+    trusted host 10.1.2.4
+    trusted network 192.168.40.0/24
+''', '''
+nameserver
+    dnsmasq
+''']
+
+def tree(dir):
+    """The files and symlinks under dir with their contents."""
+    result = {}
+    for root, dirs, files in os.walk(dir):
+        for name in files + dirs:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                result[path[len(dir):]] = 'link:' + os.readlink(path)
+            elif name in files:
+                with open(path, 'rb') as f:
+                    result[path[len(dir):]] = f.read()
+    return result
+
+class CanonicalOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def generate(self, blocks):
+        config = os.path.join(self.tmp, 'test.cfg')
+        destdir = os.path.join(self.tmp, 'out')
+        with open(config, 'w') as f:
+            f.write(MODULES + ''.join(blocks))
+        shutil.rmtree(destdir, ignore_errors = True)
+        subprocess.run([sys.executable, GEN_CONFIG, '--canonical',
+                        '-D', destdir, config], check = True,
+                       stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+        return tree(destdir)
+
+    def test_shuffled(self):
+        blocks = list(BLOCKS)
+        expected = self.generate(blocks)
+        self.assertIn('/etc/sysconfig/iptables-commands', expected)
+        rng = random.Random('canonical')
+        for i in range(ROUNDS):
+            rng.shuffle(blocks)
+            result = self.generate(blocks)
+            self.assertEqual(sorted(result.keys()), sorted(expected.keys()))
+            for path, data in expected.items():
+                self.assertEqual(result[path], data,
+                                 '%s differs in round %d' % (path, i))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+#
+# Files written by an earlier commit but not generated any more are
+# removed from the destination, also when a directory or link takes
+# their place.
+#
+
+import os, sys, shutil, tempfile, unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'src'))
+
+from genconfig.cfgfs import CfgFS
+
+class StaleFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.destdir = os.path.join(self.tmp, 'dest')
+        os.mkdir(self.destdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def commit(self, files, dirs = [], symlinks = {}, atomic = False):
+        fs = CfgFS()
+        for path in dirs:
+            fs.mkdir(path)
+        for dst, src in symlinks.items():
+            fs.symlink(src, dst)
+        for path, content in files.items():
+            f = fs.open(path)
+            f.write(content, end = '')
+            f.close()
+        return fs.commit(self.destdir, atomic)
+
+    def check_removed(self, atomic):
+        self.commit({ '/etc/a': 'a\n', '/etc/b': 'b\n' }, atomic = atomic)
+        changes = self.commit({ '/etc/a': 'a\n' }, atomic = atomic)
+        self.assertEqual(changes.paths(CfgFS.ChangeSet.REMOVED), ['/etc/b'])
+        self.assertTrue(os.path.exists(self.destdir + '/etc/a'))
+        self.assertFalse(os.path.lexists(self.destdir + '/etc/b'))
+        changes = self.commit({ '/etc/a': 'a\n' }, atomic = atomic)
+        self.assertFalse(changes)
+
+    def test_removed(self):
+        self.check_removed(False)
+
+    def test_removed_atomic(self):
+        self.check_removed(True)
+
+    def test_file_to_dir(self):
+        self.commit({ '/etc/a': 'a\n', '/etc/b': 'b\n' })
+        changes = self.commit({ '/etc/a': 'a\n' }, dirs = ['/etc/b'])
+        self.assertEqual(changes.paths(CfgFS.ChangeSet.REMOVED), [])
+        self.assertTrue(os.path.isdir(self.destdir + '/etc/b'))
+        self.assertFalse(self.commit({ '/etc/a': 'a\n' }, dirs = ['/etc/b']))
+
+    def test_file_to_link(self):
+        self.commit({ '/etc/a': 'a\n', '/etc/b': 'b\n' })
+        changes = self.commit({ '/etc/a': 'a\n' },
+                              symlinks = { '/etc/b': 'a' })
+        self.assertEqual(changes.paths(CfgFS.ChangeSet.REMOVED), [])
+        self.assertEqual(os.readlink(self.destdir + '/etc/b'), 'a')
+        self.assertFalse(self.commit({ '/etc/a': 'a\n' },
+                                     symlinks = { '/etc/b': 'a' }))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+#
+# Rewriting the iptables ruleset must not change the verdict for any
+# packet: random rulesets are evaluated for random packets before and
+# after optimizing and dispatching them.
+#
+
+import os, sys, random, ipaddress, importlib.util, tempfile, shutil
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(TESTS_DIR), 'src')
+sys.path.insert(0, SRC_DIR)
+
+from genconfig.lexer import Lexer
+from genconfig.cfgfs import CfgFS
+from genconfig.config import render
+
+def load_firewall():
+    # collect the node definitions like the lexer does, without
+    # registering them for the parser
+    path = os.path.join(SRC_DIR, 'profiles', 'common', 'modules',
+                        'firewall.py')
+    spec = importlib.util.spec_from_file_location('firewall', path)
+    module = importlib.util.module_from_spec(spec)
+    Lexer.loading = []
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        Lexer.loading = None
+    return module
+
+IPTables = load_firewall().IPTables
+
+TRUSTED = '''
+interface lan
+    config ipv4 10.0.0.254/24
+
+firewall
+    ipset-threshold 2
+    trusted network 10.1.0.0/16
+%s
+'''
+
+ROUNDS = 100
+PACKETS = 100
+
+DEVICES = ['lan1', 'lan2', 'lan3', 'wan']
+PROTOCOLS = ['tcp', 'udp']
+NETWORKS = ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.0/30',
+            '10.0.0.4/30', '10.0.1.0/24', '10.0.0.0/16']
+PORTS = ['22', '53', '80', '1:1024']
+
+def random_rule(rng, targets):
+    tokens = []
+    if rng.random() < 0.6:
+        tokens += ['-i', rng.choice(DEVICES + ['lan+'])]
+    if rng.random() < 0.2:
+        tokens += ['-o', rng.choice(DEVICES)]
+    if rng.random() < 0.4:
+        tokens += ['-p', rng.choice(PROTOCOLS)]
+    if rng.random() < 0.5:
+        tokens += ['-s', rng.choice(NETWORKS)]
+    if rng.random() < 0.3:
+        tokens += ['-d', rng.choice(NETWORKS)]
+    if rng.random() < 0.3:
+        tokens += ['--dport', rng.choice(PORTS)]
+    return ' '.join(tokens + ['-j', rng.choice(targets)])
+
+def random_packet(rng):
+    return { '-i': rng.choice(DEVICES + ['lan4']),
+             '-o': rng.choice(DEVICES),
+             '-p': rng.choice(PROTOCOLS + ['icmp']),
+             '-s': '10.0.%d.%d' % (rng.choice([0, 1, 2]), rng.randint(0, 7)),
+             '-d': '10.0.%d.%d' % (rng.choice([0, 1]), rng.randint(0, 7)),
+             '--dport': rng.choice([22, 53, 80, 443, 8080]) }
+
+def matches(rule, packet):
+    tokens = rule.split()
+    end = tokens.index('-j')
+    for opt, val in zip(tokens[0:end:2], tokens[1:end:2]):
+        if opt in ['-i', '-o']:
+            if val.endswith('+'):
+                if not packet[opt].startswith(val[:-1]):
+                    return False
+            elif packet[opt] != val:
+                return False
+        elif opt == '-p':
+            if packet[opt] != val:
+                return False
+        elif opt in ['-s', '-d']:
+            if ipaddress.ip_address(packet[opt]) not in \
+               ipaddress.ip_network(val):
+                return False
+        else:
+            lo, sep, hi = val.partition(':')
+            if not int(lo) <= packet[opt] <= int(hi if sep else lo):
+                return False
+    return True
+
+def verdict(chains, name, packet):
+    # None if the packet returns from the chain
+    for rule in chains[name][1]:
+        if not matches(rule, packet):
+            continue
+        target = rule.split()[-1]
+        if target == 'RETURN':
+            return None
+        if target in chains:
+            result = verdict(chains, target, packet)
+            if result is not None:
+                return result
+            continue
+        return target
+    return None
+
+def decide(chains, name, packet):
+    result = verdict(chains, name, packet)
+    return chains[name][0] if result is None else result
+
+def apply_delta(rules, lines):
+    rules = list(rules)
+    for line in lines:
+        op, name, rest = line.split(' ', 2)
+        index, _, rule = rest.partition(' ')
+        index = int(index) - 1
+        if op == '-R':
+            rules[index] = rule
+        elif op == '-D':
+            del rules[index]
+        else:
+            rules.insert(index, rule)
+    return rules
+
+def snapshot(table):
+    builtin = IPTables.BUILTIN_CHAINS[table.name]
+    return dict((c.name, (c.policy if c.name in builtin else None,
+                          c.rules)) for c in table.chains)
+
+class FirewallTest(unittest.TestCase):
+    def check_verdicts(self, rng, before, table):
+        after = snapshot(table)
+        for i in range(PACKETS):
+            packet = random_packet(rng)
+            for name in ['INPUT', 'FORWARD']:
+                self.assertEqual(decide(before, name, packet),
+                                 decide(after, name, packet),
+                                 '%s: %s\nbefore: %s\nafter: %s' %
+                                 (name, packet, before, after))
+
+    def random_table(self, rng, targets, chains = []):
+        table = IPTables.Table('filter', [('INPUT', 'DROP'),
+                                          ('FORWARD', 'DROP'), 'OUTPUT'])
+        for name, rules in chains:
+            c = table.chain(name)
+            for r in rules:
+                c.append(r)
+        for name in ['INPUT', 'FORWARD']:
+            c = table.chain(name)
+            for i in range(rng.randint(1, 16)):
+                c.append(random_rule(rng, targets))
+        return table
+
+    def test_optimize(self):
+        rng = random.Random('optimize')
+        targets = ['ACCEPT', 'ACCEPT', 'DROP', 'REJECT']
+        removed = 0
+        for i in range(ROUNDS):
+            table = self.random_table(rng, targets)
+            before = snapshot(table)
+            for c in table.chains:
+                if i % 3 == 0:
+                    c.remove_shadowed()
+                elif i % 3 == 1:
+                    for opt in IPTables.Spec.ADDRESSES:
+                        c.collapse(opt)
+                else:
+                    removed += c.optimize()
+            self.check_verdicts(rng, before, table)
+        self.assertTrue(removed > 0)
+
+    def test_dispatch(self):
+        rng = random.Random('dispatch')
+        targets = ['ACCEPT', 'DROP', 'REJECT', 'RETURN', 'CHECK', 'SUB']
+        created = 0
+        for i in range(ROUNDS):
+            check = [random_rule(rng, ['ACCEPT', 'DROP']) for j in range(4)]
+            sub = [random_rule(rng, ['ACCEPT', 'RETURN']) for j in range(3)]
+            table = self.random_table(rng, targets,
+                                      [('CHECK', check), ('SUB', sub)])
+            # unconditional jumps get the chain inlined
+            table.chain('INPUT').insert('-j CHECK', index = rng.randint(0, 2))
+            table.chain('FORWARD').insert('-j SUB', index = rng.randint(0, 2))
+            before = snapshot(table)
+            for name in ['INPUT', 'FORWARD']:
+                created += table.dispatch(table.chain(name))
+            self.check_verdicts(rng, before, table)
+        self.assertTrue(created > 0)
+
+    def test_ipset_removed(self):
+        hosts = ['10.0.0.1', '10.0.0.5', '10.0.0.9']
+        for i in range(len(hosts) + 1):
+            kept = hosts[:i] + hosts[i + 1:]
+            text = TRUSTED % ''.join('    trusted host %s\n' % h
+                                     for h in kept)
+            tree = render(text = text)
+            restore = tree['/etc/sysconfig/ipset']['data'].decode()
+            lines = restore.splitlines()
+            # the new entries replace the live set as a whole
+            self.assertEqual(lines[-2:], ['swap trusted-inet-new trusted-inet',
+                                          'destroy trusted-inet-new'])
+            self.assertIn('flush trusted-inet-new', lines)
+            added = [l.split()[2] for l in lines if l.startswith('add ')]
+            self.assertEqual(sorted(added), sorted(kept + ['10.1.0.0/16']))
+            self.assertTrue(all(l.split()[1] == 'trusted-inet-new'
+                                for l in lines if l.startswith('add ')))
+
+    def test_chain_delta(self):
+        rng = random.Random('delta')
+        targets = ['ACCEPT', 'DROP']
+        for i in range(ROUNDS):
+            old = [random_rule(rng, targets) for j in range(rng.randint(0, 8))]
+            new = list(old)
+            for j in range(rng.randint(0, 4)):
+                k = rng.randint(0, len(new))
+                op = rng.choice(['insert', 'delete', 'replace'])
+                if op == 'insert' or k == len(new):
+                    new.insert(k, random_rule(rng, targets))
+                elif op == 'delete':
+                    del new[k]
+                else:
+                    new[k] = random_rule(rng, targets)
+            lines = IPTables.Table.chain_delta('INPUT', old, new)
+            self.assertEqual(apply_delta(old, lines), new)
+            self.assertTrue(len(lines) <= 8)
+            self.assertEqual(IPTables.Table.chain_delta('INPUT', new, new), [])
+
+    def test_delta_unchanged(self):
+        table = self.random_table(random.Random('unchanged'), ['ACCEPT'])
+        previous = dict((c.name, (c.policy, c.rules)) for c in table.chains)
+        self.assertEqual(table.delta(previous), [])
+
+        # the delta of the last change is kept if nothing changed
+        path = IPTables.CONFIG_FILES['delta']
+        prevdir = tempfile.mkdtemp()
+        try:
+            for last in [None, '*filter\n-D INPUT 1\nCOMMIT\n']:
+                if last is not None:
+                    os.makedirs(os.path.dirname(prevdir + path))
+                    with open(prevdir + path, 'w') as f:
+                        f.write(last)
+                fs = CfgFS()
+                fs.prevdir = prevdir
+                ipt = IPTables(fs)
+                ipt.tables = { 'filter': table }
+                ipt.write_delta(fs, { 'filter': previous })
+                if last is None:
+                    self.assertNotIn(path, fs.files)
+                else:
+                    self.assertEqual(fs.files[path].content(), last)
+        finally:
+            shutil.rmtree(prevdir)
+
+if __name__ == '__main__':
+    unittest.main()